@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+# Set up the benchmark environment
+opd = os.path.dirname
+sys.path.insert(0, opd(os.path.abspath(__file__)))
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+import debt_snowball as ds
+
+DEBT_COUNTS = [2, 10, 50, 100, 500]
+HORIZONS = [12, 60, 120, 360]
+
+QUICK_DEBT_COUNTS = [2, 10]
+QUICK_HORIZONS = [12, 120]
+
+def clear_caches():
+    ds.horizon_cache.clear()
+    ds.table_cache.clear()
+
+def bench(func, repeat=5, setup=clear_caches):
+    """Best and mean wall time of func(), in seconds, with setup() before each run"""
+    times = []
+    for i in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times), sum(times) / len(times)
+
+def portfolio_fields(debts, months, seed=0):
+    """Form fields for debts that each take about months months to pay off on their own"""
+    rand = random.Random(seed)
+    fields = {'row_count': str(debts)}
+
+    for num in range(1, debts + 1):
+        balance = rand.uniform(500, 50000)
+        apr = rand.uniform(0, 25)
+        monthly_pr = apr / 1200
+        if monthly_pr:
+            payment = balance * monthly_pr / (1 - (1 + monthly_pr) ** -months)
+        else:
+            payment = balance / months
+        fields.update({'debt_name_%s' % num: 'debt %s' % num,
+                       'balance_%s' % num: '%.2f' % balance,
+                       'payment_%s' % num: '%.2f' % (payment + 0.01),
+                       'apr_%s' % num: '%.3f' % apr})
+
+    return fields
+
+def bench_money_fmt(count=10000):
+    rand = random.Random(0)
+    values = [rand.uniform(-1e6, 1e6) for i in range(count)]
+
+    return [('money_fmt_decimal', count, None,
+             bench(lambda: [ds._decimal_money_fmt(v) for v in values])),
+            ('money_fmt', count, None, bench(lambda: [ds.money_fmt(v) for v in values])),
+            ('money_fmt_column', count, None, bench(lambda: ds.money_fmt_column(values)))]
+
+def bench_amortization(months):
+    fields = portfolio_fields(1, months)
+    args = (fields['debt_name_1'], fields['balance_1'], fields['payment_1'], fields['apr_1'])
+
+    return [('do_amortization', 1, months, bench(lambda: ds.do_amortization(*args)))]
+
+def bench_portfolio(debts, months, client):
+    fields = portfolio_fields(debts, months)
+    sorted_debts = ds.sort_by_payoff_time(fields)
+
+    return [('sort_by_payoff_time', debts, months,
+             bench(lambda: ds.sort_by_payoff_time(fields))),
+            ('calculate_combined_payoff_tables', debts, months,
+             bench(lambda: ds.calculate_combined_payoff_tables(sorted_debts, formatted=False))),
+            ('calculate_combined_payoff_tables_formatted', debts, months,
+             bench(lambda: ds.calculate_combined_payoff_tables(sorted_debts))),
+            ('application', debts, months,
+             bench(lambda: client.post(ds.rc.base_path, data=fields).data, repeat=3))]
+
+def run(debt_counts, horizons):
+    # The largest portfolios are over the default request budget
+    ds.rc.max_debts = ds.rc.max_months = None
+    client = Client(ds.application, BaseResponse)
+    results = bench_money_fmt()
+
+    for months in horizons:
+        results.extend(bench_amortization(months))
+
+    for debts in debt_counts:
+        for months in horizons:
+            results.extend(bench_portfolio(debts, months, client))
+
+    return [{'benchmark': name, 'debts': debts, 'months': months, 'best': best, 'mean': mean}
+            for name, debts, months, (best, mean) in results]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the debt snowball calculator')
+    parser.add_argument('--quick', action='store_true', help='only run the small portfolios')
+    parser.add_argument('--json', metavar='OUTPUT',
+                        help='also write the results as JSON to OUTPUT (- for stdout)')
+    args = parser.parse_args()
+
+    if args.quick:
+        results = run(QUICK_DEBT_COUNTS, QUICK_HORIZONS)
+    else:
+        results = run(DEBT_COUNTS, HORIZONS)
+
+    if args.json:
+        report = {'version': ds.__version__, 'python': platform.python_version(),
+                  'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=1)
+            sys.exit(0)
+        with open(args.json, 'w') as output_file:
+            json.dump(report, output_file, indent=1)
+
+    print('%-44s %6s %6s %12s %12s' % ('benchmark', 'debts', 'months', 'best ms', 'mean ms'))
+    for result in results:
+        print('%-44s %6s %6s %12.3f %12.3f' % (result['benchmark'], result['debts'],
+                                               result['months'] or '', result['best'] * 1000,
+                                               result['mean'] * 1000))
@@ -1,15 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from array import array
+import calendar
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import copy
+import csv
 import datetime
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
 import re
+import secrets
+import sqlite3
 import sys
+import threading
+import time
 from urllib.parse import urlparse
+import zlib
 
-from dateutil.relativedelta import relativedelta
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from werkzeug import Request, Response
-from werkzeug.exceptions import HTTPException, BadRequest, NotFound
+from werkzeug.exceptions import HTTPException, BadRequest, MethodNotAllowed, NotFound
+from werkzeug.serving import BaseWSGIServer, run_simple
+
+try:
+    import brotli
+except ImportError: #pragma: no cover
+    brotli = None
 
 import debt_snowball_config as rc
 
@@ -36,6 +60,193 @@ class InvalidData(Exception):
 class DuplicateNames(Exception):
     pass
 
+class InvalidStrategy(Exception):
+    pass
+
+class InvalidTarget(Exception):
+    pass
+
+class InvalidStart(Exception):
+    pass
+
+class TooLarge(Exception):
+    pass
+
+class InvalidView(Exception):
+    pass
+
+class InvalidRange(Exception):
+    pass
+
+# Problems with the submitted debts, reported back to the user
+INPUT_ERRORS = (MissingFields, TooFewDebts, NegativeNumbers, DuplicateNames, RisingBalance,
+                InvalidData, InvalidStrategy, InvalidTarget, InvalidStart, TooLarge,
+                InvalidView, InvalidRange, ValueError)
+
+ScheduleRow = namedtuple('ScheduleRow', ['month', 'start_balance', 'new_balance', 'payment',
+                                         'paid_balance', 'interest_payment', 'principal_payment'])
+
+# Totals for rows start up to end of a payoff table, for the summary views
+SummaryRow = namedtuple('SummaryRow', ['first_month', 'last_month', 'start', 'end',
+                                       'start_balance', 'payment', 'paid_balance',
+                                       'interest_payment', 'principal_payment'])
+
+def add_months(date, months):
+    """date moved on by months, keeping the day of the month where the
+    month is long enough and using its last day otherwise."""
+    year, month = divmod(date.month - 1 + months, 12)
+    year += date.year
+    month += 1
+    return datetime.date(year, month, min(date.day, calendar.monthrange(year, month)[1]))
+
+# Dates of the months of schedules, by start date; see month_dates()
+_calendars = OrderedDict()
+_calendars_lock = threading.Lock()
+
+def month_dates(start_date, count):
+    """A list of at least the first count month dates counted from
+    start_date, add_months(start_date, n) for month n.
+
+    Schedules count months as integers from their start date and only turn
+    them into dates for output. Nearly all of them start today, so the
+    dates are worked out once and the lists shared, growing as longer
+    schedules need them. Treat them as read-only.
+    """
+    dates = _calendars.get(start_date)
+    if dates is not None and len(dates) >= count:
+        return dates
+
+    with _calendars_lock:
+        dates = _calendars.get(start_date)
+        if dates is None:
+            dates = _calendars[start_date] = []
+            while len(_calendars) > 16:
+                _calendars.popitem(last=False)
+        # Grow a copy, so readers of the old list never see it change
+        if len(dates) < count:
+            dates = dates + [add_months(start_date, months)
+                             for months in range(len(dates), max(count, 2 * len(dates), 480))]
+            _calendars[start_date] = dates
+
+    return dates
+
+def month_date(start_date, months):
+    """add_months(start_date, months) from the shared calendar."""
+    return month_dates(start_date, months + 1)[months]
+
+class PayoffTable(object):
+    """A debt's payoff schedule stored as columns of floats, or of integer
+    cents when cents is set.
+
+    Only the start balance, balance after interest and payment are kept;
+    the other columns are derived the same way the amortization loop
+    computes them. Row n is month first_month + n counted from start_date.
+    """
+    __slots__ = ('debt_name', 'start_date', 'first_month', 'scale',
+                 'start_balance', 'new_balance', 'payment')
+
+    def __init__(self, debt_name, start_date, first_month=0, cents=False):
+        self.debt_name = debt_name
+        self.start_date = start_date
+        self.first_month = first_month
+        self.scale = 100.0 if cents else 1
+        typecode = 'q' if cents else 'd'
+        self.start_balance = array(typecode)
+        self.new_balance = array(typecode)
+        self.payment = array(typecode)
+
+    def append(self, start_balance, new_balance, payment):
+        self.start_balance.append(start_balance)
+        self.new_balance.append(new_balance)
+        self.payment.append(payment)
+
+    def month(self, index):
+        return month_date(self.start_date, self.first_month + index)
+
+    def __len__(self):
+        return len(self.payment)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('payoff table index out of range')
+        return PayoffRow(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield PayoffRow(self, index)
+
+class PayoffRow(object):
+    """View of one month of a PayoffTable, with the fields of ScheduleRow."""
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def month(self):
+        return self.table.month(self.index)
+
+    @property
+    def start_balance(self):
+        return self.table.start_balance[self.index] / self.table.scale
+
+    @property
+    def new_balance(self):
+        return self.table.new_balance[self.index] / self.table.scale
+
+    @property
+    def payment(self):
+        return self.table.payment[self.index] / self.table.scale
+
+    @property
+    def paid_balance(self):
+        table = self.table
+        return (table.new_balance[self.index] - table.payment[self.index]) / table.scale
+
+    @property
+    def interest_payment(self):
+        table = self.table
+        return (table.new_balance[self.index] - table.start_balance[self.index]) / table.scale
+
+    @property
+    def principal_payment(self):
+        table = self.table
+        interest_payment = table.new_balance[self.index] - table.start_balance[self.index]
+        return (table.payment[self.index] - interest_payment) / table.scale
+
+def to_cents(value):
+    """Round a money amount half-even to an integer number of cents."""
+    if not isinstance(value, Decimal):
+        try:
+            value = Decimal(str(value).strip())
+        except InvalidOperation:
+            raise ValueError("Invalid money amount '%s'" % value)
+
+    if not value.is_finite():
+        raise ValueError("Invalid money amount '%s'" % value)
+
+    return int(value.quantize(Decimal('0.01')) * 100)
+
+def _monthly_rate(apr):
+    try:
+        if not isinstance(apr, Decimal):
+            apr = Decimal(str(apr).strip())
+        numerator, denominator = apr.as_integer_ratio()
+    except (InvalidOperation, ValueError, OverflowError):
+        raise ValueError("Invalid APR '%s'" % apr)
+
+    return numerator, denominator * 1200
+
+def _cents_interest(balance, rate):
+    """A month's interest on balance cents, rounded half-even to the cent."""
+    interest, remainder = divmod(balance * rate[0], rate[1])
+    if remainder * 2 > rate[1] or (remainder * 2 == rate[1] and interest % 2):
+        interest += 1
+    return interest
+
 def money_fmt(value, places=2, curr='$', sep=',', dp='.',
              pos='', neg='-', trailneg=''):
     """Convert Decimal to a money formatted string.
@@ -63,6 +274,26 @@ def money_fmt(value, places=2, curr='$', sep=',', dp='.',
     '<0.02>'
 
     """
+    if isinstance(value, int) and abs(value) < 2**53:
+        value = float(value)
+
+    # Formatting a float rounds its exact binary value half-even, the same
+    # as quantizing Decimal(value), without building a Decimal.
+    if isinstance(value, float) and math.isfinite(value):
+        digits = format(value, ',.%df' % places)
+        sign = digits[0] == '-'
+        if sign:
+            digits = digits[1:]
+        if sep != ',' or dp != '.':
+            digits = digits.translate({ord(','): sep, ord('.'): dp})
+        if sign:
+            return neg + curr + digits + trailneg
+        return pos + curr + digits
+
+    return _decimal_money_fmt(value, places, curr, sep, dp, pos, neg, trailneg)
+
+def _decimal_money_fmt(value, places=2, curr='$', sep=',', dp='.',
+                       pos='', neg='-', trailneg=''):
     if not isinstance(value, Decimal):
         value = Decimal(value)
 
@@ -90,26 +321,57 @@ def money_fmt(value, places=2, curr='$', sep=',', dp='.',
     build(neg if sign else pos)
     return ''.join(reversed(result))
 
-def do_amortization(debt_name, balance, payment, apr, additional_start=datetime.date(9999, 12,31), additional_payment=0):
-    apr = float(apr)/100.0
-    monthly_pr = apr/12.0
+def money_fmt_column(values, places=2, curr='$', sep=',', dp='.',
+                     pos='', neg='-', trailneg=''):
+    """money_fmt() every number in values, e.g. a PayoffTable column."""
+    if (places, curr, sep, dp, pos, neg, trailneg) != (2, '$', ',', '.', '', '-', ''):
+        return [money_fmt(value, places, curr, sep, dp, pos, neg, trailneg) for value in values]
+
+    return ['$' + digits if digits[0] != '-' else '-$' + digits[1:]
+            for digits in map('{:,.2f}'.format, values)]
+
+def do_amortization(debt_name, balance, payment, apr, additional_start=datetime.date(9999, 12,31), additional_payment=0,
+                    cents=False):
+    return [_format_row(row) for row in iter_amortization(debt_name, balance, payment, apr, additional_start,
+                                                          additional_payment, cents)]
+
+def iter_amortization(debt_name, balance, payment, apr, additional_start=datetime.date(9999, 12,31),
+                      additional_payment=0, cents=False):
+    """Yield the schedule of do_amortization() as unformatted ScheduleRows.
+
+    With cents, balances are kept as integer cents and each month's interest
+    is rounded half-even to the cent, so the schedule is exact.
+    """
+    if cents:
+        rate = _monthly_rate(apr)
+        original_payment = to_cents(payment)
+        balance = to_cents(balance)
+        additional_payment = to_cents(additional_payment)
+        scale = 100.0
+    else:
+        apr = float(apr)/100.0
+        monthly_pr = apr/12.0
+        original_payment = float(payment)
+        balance = float(balance)
+        additional_payment = float(additional_payment)
+        scale = 1
 
     if rc.debug: #pragma: no cover
         print("month, start_balance, new_balance, paid_balance, payment, interest_payment, principal_payment")
 
     month_count = 0
     start_date = datetime.date.today()
-    results = []
-    original_payment = float(payment)
-    balance = float(balance)
-    additional_payment = float(additional_payment)
+    # Months are counted as integers; the additional payment starts in month step
+    step = _first_month_after(start_date, additional_start)
 
     while balance > 0:
         start_balance = balance
-        new_balance = balance + balance * monthly_pr
-        this_month = start_date + relativedelta(months=month_count)
+        if cents:
+            new_balance = balance + _cents_interest(balance, rate)
+        else:
+            new_balance = balance + balance * monthly_pr
 
-        if additional_payment > 0 and this_month > additional_start:
+        if additional_payment > 0 and month_count >= step:
             payment = original_payment + additional_payment
         else:
             payment = original_payment
@@ -128,170 +390,1440 @@ def do_amortization(debt_name, balance, payment, apr, additional_start=datetime.
 
         balance = paid_balance
 
+        this_month = month_date(start_date, month_count)
+        row = ScheduleRow(this_month, start_balance / scale, new_balance / scale, payment / scale,
+                          paid_balance / scale, interest_payment / scale, principal_payment / scale)
+
         if rc.debug: #pragma: no cover
             print("%s-%s" % (this_month.year, this_month.month),
-                  money_fmt(start_balance), money_fmt(new_balance),
-                  money_fmt(paid_balance), money_fmt(payment),
-                  money_fmt(interest_payment), money_fmt(principal_payment))
+                  money_fmt(row.start_balance), money_fmt(row.new_balance),
+                  money_fmt(row.paid_balance), money_fmt(row.payment),
+                  money_fmt(row.interest_payment), money_fmt(row.principal_payment))
 
         month_count += 1
 
-        results.append({'month': this_month,
-                        'start_balance': money_fmt(start_balance),
-                        'payment': money_fmt(payment),
-                        'new_balance': money_fmt(new_balance),
-                        'paid_balance': money_fmt(paid_balance),
-                        'interest_payment': money_fmt(interest_payment),
-                        'principal_payment': money_fmt(principal_payment)})
+        yield row
+
+def _format_row(row):
+    return {'month': row.month,
+            'start_balance': money_fmt(row.start_balance),
+            'payment': money_fmt(row.payment),
+            'new_balance': money_fmt(row.new_balance),
+            'paid_balance': money_fmt(row.paid_balance),
+            'interest_payment': money_fmt(row.interest_payment),
+            'principal_payment': money_fmt(row.principal_payment)}
+
+def _remaining_balance(balance, payment, monthly_pr, months):
+    if monthly_pr == 0:
+        return balance - payment * months
+
+    growth = math.expm1(months * math.log1p(monthly_pr))
+    return balance + balance * growth - payment * growth / monthly_pr
+
+def payoff_months(debt_name, balance, payment, apr):
+    """Number of payments do_amortization() needs to pay off a debt.
+
+    Solves the annuity formula for the payoff horizon instead of walking the
+    schedule, then nudges the result so it lands on the exact final month.
+    """
+    monthly_pr = float(apr)/100.0/12.0
+    balance = float(balance)
+    payment = float(payment)
+
+    if balance <= 0:
+        return 0
+
+    # Same test as the first month of do_amortization(); if the first payment
+    # doesn't reduce the balance, no later one will.
+    if balance + balance * monthly_pr - payment >= balance:
+        raise RisingBalance(debt_name)
+
+    if monthly_pr == 0:
+        months = math.ceil(balance / payment)
+    else:
+        months = math.ceil(-math.log1p(-balance * monthly_pr / payment) / math.log1p(monthly_pr))
+
+    months = max(months, 1)
+    while months > 1 and _remaining_balance(balance, payment, monthly_pr, months - 1) <= 0:
+        months -= 1
+    while _remaining_balance(balance, payment, monthly_pr, months) > 0:
+        months += 1
+
+    return months
+
+def _first_month_after(start_date, date):
+    """Index of the first schedule month starting after date."""
+    months = (date.year - start_date.year) * 12 + date.month - start_date.month
+    if months < 0:
+        return 0
+    if add_months(start_date, months) <= date:
+        months += 1
+    return months
+
+class ResultCache(object):
+    """Least recently used cache whose entries also expire after ttl seconds.
+
+    Cached values are shared between callers and must be treated as read-only.
+    """
+    def __init__(self, maxsize=256, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Return the value cached for key, calling compute() on a miss."""
+        now = self.clock()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl is None or now - entry[0] < self.ttl):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = compute()
+
+        with self._lock:
+            self._entries[key] = (now, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+horizon_cache = ResultCache(getattr(rc, 'cache_size', 256), getattr(rc, 'cache_ttl', 3600))
+table_cache = ResultCache(getattr(rc, 'cache_size', 256), getattr(rc, 'cache_ttl', 3600))
+
+def cache_stats():
+    return {'horizon': horizon_cache.stats(), 'tables': table_cache.stats()}
+
+class Metrics(object):
+    """Per-stage timings and counters, for the whole process and for the
+    request being handled by the current thread."""
+    def __init__(self, prefix='debtsnowball'):
+        self.prefix = prefix
+        # Off when forked server processes would each only report their own
+        self.served = True
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start_request(self):
+        self._local.timings = OrderedDict()
+
+    def request_timings(self):
+        return getattr(self._local, 'timings', None) or OrderedDict()
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                count, total = self.stages.get(stage, (0, 0.0))
+                self.stages[stage] = (count + 1, total + elapsed)
+            timings = getattr(self._local, 'timings', None)
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0.0) + elapsed
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def server_timing(self):
+        """The current request's timings as a Server-Timing header value."""
+        return ', '.join('%s;dur=%.3f' % (stage, elapsed * 1000)
+                         for stage, elapsed in self.request_timings().items())
+
+    def prometheus(self):
+        """Everything recorded so far, in the Prometheus text format."""
+        lines = ['# TYPE %s_stage_seconds summary' % self.prefix]
+
+        with self._lock:
+            for stage, (count, total) in self.stages.items():
+                lines.append('%s_stage_seconds_sum{stage="%s"} %r' % (self.prefix, stage, total))
+                lines.append('%s_stage_seconds_count{stage="%s"} %d' % (self.prefix, stage, count))
+
+            last_name = None
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != last_name:
+                    lines.append('# TYPE %s_%s_total counter' % (self.prefix, name))
+                    last_name = name
+                label_text = ','.join('%s="%s"' % label for label in labels)
+                lines.append('%s_%s_total%s %r' % (self.prefix, name,
+                                                   '{%s}' % label_text if labels else '', value))
+
+        caches = [('horizon', horizon_cache.stats()), ('tables', table_cache.stats())]
+        for stat, kind in [('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')]:
+            suffix = '_total' if kind == 'counter' else ''
+            lines.append('# TYPE %s_cache_%s%s %s' % (self.prefix, stat, suffix, kind))
+            for name, stats in caches:
+                lines.append('%s_cache_%s%s{cache="%s"} %d' % (self.prefix, stat, suffix, name, stats[stat]))
+
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def _money_key(value):
+    # Equal amounts written differently ('10000', '10000.00') share a key,
+    # which also has the same repr for input_etag()
+    if isinstance(value, Decimal):
+        return value.normalize()
+    try:
+        return Decimal(str(value).strip()).normalize()
+    except InvalidOperation:
+        raise ValueError("Invalid number '%s'" % value)
+
+def _debt_key(debt):
+    return (debt['debt_name'], _money_key(debt['balance']), _money_key(debt['payment']),
+            _money_key(debt['apr']))
+
+def add_payoff_times(debts):
+    """Copies of parse_debts() output with each debt's stand-alone payoff
+    time in 'payments'."""
+    results = []
+
+    for debt in debts:
+        key = (_money_key(debt['balance']), _money_key(debt['payment']), _money_key(debt['apr']))
+        payments = horizon_cache.get(key, lambda: payoff_months(debt['debt_name'], debt['balance'],
+                                                                debt['payment'], debt['apr']))
+        results.append(dict(debt, payments=payments))
 
     return results
 
+def prepare_debts(fields):
+    """The debts in the fields, in form order, with their stand-alone payoff
+    times in 'payments'."""
+    return add_payoff_times(parse_debts(fields))
+
+# Keys ordering debts for each payoff strategy; ties keep form order
+STRATEGIES = OrderedDict([
+    ('payoff_time', lambda debt: debt['payments']),
+    ('snowball', lambda debt: debt['balance']),
+    ('avalanche', lambda debt: -debt['apr']),
+    ('custom', None),
+])
+
+def order_debts(debts, strategy='payoff_time'):
+    """Order prepare_debts() output to be paid off following strategy.
+
+    payoff_time pays the debt that would be paid off first on its own first,
+    snowball the smallest balance, avalanche the highest APR, and custom
+    keeps the order the debts were entered in.
+    """
+    if strategy not in STRATEGIES:
+        raise InvalidStrategy(strategy)
+
+    if STRATEGIES[strategy] is None:
+        return list(debts)
+
+    return sorted(debts, key=STRATEGIES[strategy])
+
 def sort_by_payoff_time(fields):
-    debts = {}
+    return order_debts(prepare_debts(fields), 'payoff_time')
 
-    for num in range(1, int(fields['row_count']) + 1):
-        debt_name = fields["debt_name_%s" % num]
-        if debt_name == '':
-            continue
+class Snowball(object):
+    """A snowball payoff in progress, advanced a month at a time by step().
 
-        balance = fields["balance_%s" % num]
-        payment = fields["payment_%s" % num]
-        apr = fields["apr_%s" % num].strip()
+    extra_payment is added to the freed payments from month extra_start on.
+    Without record the months aren't kept in PayoffTables, which is all
+    that's needed to find out when the debts are paid off.
+    """
+    def __init__(self, sorted_debts, immediate_rollover=False, cents=False, record=True,
+                 extra_payment=0, extra_start=0):
+        self.start_date = datetime.date.today()
+        self.names = [debt['debt_name'] for debt in sorted_debts]
+        self.immediate_rollover = immediate_rollover
+        self.cents = cents
+
+        if cents:
+            self.balances = [to_cents(debt['balance']) for debt in sorted_debts]
+            self.payments = [to_cents(debt['payment']) for debt in sorted_debts]
+            self.rates = [_monthly_rate(debt['apr']) for debt in sorted_debts]
+            self.extra_payment = to_cents(extra_payment)
+        else:
+            self.balances = [float(debt['balance']) for debt in sorted_debts]
+            self.payments = [float(debt['payment']) for debt in sorted_debts]
+            self.rates = [float(debt['apr'])/100.0/12.0 for debt in sorted_debts]
+            self.extra_payment = float(extra_payment)
+        self.extra_start = extra_start
+
+        if record:
+            self.tables = [PayoffTable(name, self.start_date, cents=cents) for name in self.names]
+        else:
+            self.tables = None
+
+        self.active = [num for num, balance in enumerate(self.balances) if balance > 0]
+        self.freed = sum(self.payments[num] for num, balance in enumerate(self.balances) if balance <= 0)
+        self.month = 0
+
+    def step(self):
+        balances = self.balances
+        extra = self.freed
+        if self.month >= self.extra_start:
+            extra += self.extra_payment
+        still_active = []
+
+        for num in self.active:
+            start_balance = balances[num]
+            if self.cents:
+                new_balance = start_balance + _cents_interest(start_balance, self.rates[num])
+            else:
+                new_balance = start_balance + start_balance * self.rates[num]
+            payment = self.payments[num] + extra
+            extra = 0
+
+            paid_balance = new_balance - payment
+
+            if paid_balance >= start_balance:
+                raise RisingBalance(self.names[num])
+
+            if paid_balance < 0:
+                if self.immediate_rollover:
+                    extra = -paid_balance
+                paid_balance = 0
+                payment = new_balance
+
+            balances[num] = paid_balance
+
+            if self.tables is not None:
+                self.tables[num].append(start_balance, new_balance, payment)
+
+                if rc.debug: #pragma: no cover
+                    row = self.tables[num][-1]
+                    print(self.names[num], "%s-%s" % (row.month.year, row.month.month),
+                          money_fmt(row.start_balance), money_fmt(row.new_balance),
+                          money_fmt(row.paid_balance), money_fmt(row.payment),
+                          money_fmt(row.interest_payment), money_fmt(row.principal_payment))
+
+            if paid_balance > 0:
+                still_active.append(num)
+            else:
+                self.freed += self.payments[num]
+
+        self.active = still_active
+        self.month += 1
+
+    def run(self, until=None):
+        """Step until the debts are paid off, or until month until."""
+        while self.active and (until is None or self.month < until):
+            self.step()
+        return self
+
+    def copy(self):
+        """A copy to carry on from this month with, without recorded months."""
+        other = copy.copy(self)
+        other.balances = list(self.balances)
+        other.active = list(self.active)
+        other.tables = None
+        return other
+
+def simulate_snowball(sorted_debts, immediate_rollover=False, formatted=True, cents=False):
+    """Pay down all debts together, one month at a time.
+
+    Each month the payments of debts paid off in earlier months go to the
+    first debt, in sorted_debts order, that still has a balance. With
+    immediate_rollover, whatever is left of a payment in a debt's payoff
+    month goes on to the next debt in that same month instead of waiting for
+    the following one.
+
+    Charts are lists of money_fmt() formatted rows, or PayoffTables when
+    formatted is False so formatting can be left to the template. With
+    cents, the arithmetic is done in integer cents as in iter_amortization().
+    """
+    tables = Snowball(sorted_debts, immediate_rollover, cents).run().tables
 
-        payments = len(do_amortization(debt_name, balance, payment, apr))
+    if formatted:
+        return [{'debt_name': table.debt_name, 'payoff_chart': [_format_row(row) for row in table]}
+                for table in tables]
 
-        debts[debt_name] = {'debt_name': debt_name, 'payments': payments, 'balance': balance,
-                            'payment': payment, 'apr': apr}
+    return [{'debt_name': table.debt_name, 'payoff_chart': table} for table in tables]
 
-    sorted_debts = sorted(debts.values(), key=lambda x: x['payments'])
+def solve_extra_payment(sorted_debts, months, extra_start=0, immediate_rollover=False, cents=False):
+    """Smallest extra monthly payment, to the cent, that pays off all the
+    debts within the first months months.
 
-    return sorted_debts
+    The extra payment starts in month extra_start. The months before that
+    are simulated once, and every step of the binary search carries on from
+    there. Raises InvalidTarget when no extra payment is enough.
+    """
+    base = Snowball(sorted_debts, immediate_rollover, cents, record=False).run(until=extra_start)
 
-def calculate_combined_payoff_tables(sorted_debts):
-    additional_start = datetime.date(9999, 12,31)
-    additional_payment = 0
-    results = []
+    def paid_off(extra_cents):
+        snowball = base.copy()
+        snowball.extra_payment = extra_cents if cents else extra_cents / 100.0
+        return not snowball.run(until=months).active
+
+    if paid_off(0):
+        return 0.0
+
+    # A month's interest plus the whole balance pays everything off as soon
+    # as the extra payment can reach every debt, if it can at all.
+    if cents:
+        high = sum(base.balances[num] + _cents_interest(base.balances[num], base.rates[num])
+                   for num in base.active)
+    else:
+        high = math.ceil(sum(base.balances[num] * (1 + base.rates[num]) for num in base.active) * 100)
+    high += 1
+    if not paid_off(high):
+        raise InvalidTarget
+
+    low = 0
+    while high - low > 1:
+        middle = (low + high) // 2
+        if paid_off(middle):
+            high = middle
+        else:
+            low = middle
+
+    return high / 100.0
 
-    for debt in sorted_debts:
-        results.append({'debt_name': debt['debt_name'],
-                        'payoff_chart': do_amortization(debt['debt_name'],
-                                                        debt['balance'], debt['payment'],
-                                                        debt['apr'], additional_start,
-                                                        additional_payment)})
+# Process pool for simulations, see start_simulation_pool()
+simulation_pool = None
 
-        additional_start = results[-1]['payoff_chart'][-1]['month']
-        additional_payment = additional_payment + float(debt['payment'])
+def start_simulation_pool(workers):
+    """Run snowball simulations in a pool of worker processes, so a thread
+    running a big portfolio doesn't hold the GIL while others wait."""
+    global simulation_pool
+    simulation_pool = ProcessPoolExecutor(max_workers=workers)
+    return simulation_pool
 
+def stop_simulation_pool():
+    global simulation_pool
+    if simulation_pool is not None:
+        simulation_pool.shutdown()
+        simulation_pool = None
+
+def _simulate(sorted_debts, immediate_rollover, formatted, cents):
+    if simulation_pool is None:
+        results = simulate_snowball(sorted_debts, immediate_rollover, formatted, cents)
+    else:
+        results = simulation_pool.submit(simulate_snowball, sorted_debts, immediate_rollover,
+                                         formatted, cents).result()
+
+    metrics.count('months_simulated', max([len(debt['payoff_chart']) for debt in results] or [0]))
     return results
 
-def process_form(fields):
+def calculate_combined_payoff_tables(sorted_debts, immediate_rollover=False, formatted=True, cents=False):
+    # Schedules start today, so the date is part of the key
+    key = (datetime.date.today(), tuple(_debt_key(debt) for debt in sorted_debts),
+           immediate_rollover, formatted, cents)
+    return table_cache.get(key, lambda: _simulate(sorted_debts, immediate_rollover, formatted, cents))
+
+# Currency signs, percent signs and thousands separators allowed in amounts
+AMOUNT_JUNK = re.compile('[$%,]')
+
+def parse_amount(value):
+    """An amount typed into the form as a Decimal."""
+    try:
+        amount = Decimal(AMOUNT_JUNK.sub('', value.strip()))
+    except InvalidOperation:
+        raise ValueError("Invalid number '%s'" % value)
+
+    if not amount.is_finite():
+        raise ValueError("Invalid number '%s'" % value)
+    if amount < 0:
+        raise NegativeNumbers
+    return amount
+
+def parse_debts(fields):
+    """Check the submitted debts and return them, in form order, as dicts of
+    debt_name and Decimal balance, payment and apr."""
     ##TODO: Do this checking client-side too
     ##TODO: Return names of fields to highlight in red
-    ##TODO: Move a good chunk of this into validate_form()
-    debt_count = 0
-    debt_names = {}
+    row_count = int(fields['row_count'])
+    if row_count > getattr(rc, 'max_rows', 1000):
+        raise TooLarge
+
+    debts = []
+    debt_names = set()
+
+    for num in range(1, row_count + 1):
+        num = str(num)
+        debt_name = fields.get('debt_name_' + num, '')
+        values = [fields.get(f + num, '') for f in ('balance_', 'payment_', 'apr_')]
+
+        # Make sure all values are filled out if one value on a line is filled out
+        not_blank = [bool(value.strip()) for value in values]
+        if not debt_name.strip():
+            if any(not_blank):
+                raise MissingFields
+            continue
+        if not all(not_blank):
+            raise MissingFields
 
-    # Sanitized fields
-    s_fields = fields.copy()
+        balance, payment, apr = [parse_amount(value) for value in values]
+        debts.append({'debt_name': debt_name, 'balance': balance, 'payment': payment, 'apr': apr})
+        debt_names.add(debt_name)
 
-    # Make sure all values are filled out if one value on a line is filled out
-    for num in range(1, int(fields['row_count']) + 1):
-        not_blank = [bool(fields["%s_%s" % (f, num)].strip()) for f in ['debt_name', 'balance', 'payment', 'apr']]
-        if any(not_blank) and not all(not_blank):
-            raise MissingFields
+    if len(debts) < 2:
+        raise TooFewDebts
 
-        for f in ['balance', 'payment', 'apr']:
-            s_fields["%s_%s" % (f, num)] = re.sub('[$%,]', '', s_fields["%s_%s" % (f, num)].strip())
+    if len(debt_names) < len(debts):
+        raise DuplicateNames
 
-        if any([s_fields["debt_name_%s" % (num)] != '' and float(s_fields["%s_%s" % (f, num)]) < 0 for f in ['balance', 'payment', 'apr']]):
-            raise NegativeNumbers
+    return debts
 
-        if s_fields["debt_name_%s" % (num)] == '':
-            continue
+def ordered_debts(fields, strategy=None):
+    """Validate the fields and order the debts by strategy, or else the
+    optional 'strategy' field."""
+    with metrics.timed('parse'):
+        debts = parse_debts(fields)
 
-        debt_names[s_fields["debt_name_%s" % num]] = 1
+    with metrics.timed('sort'):
+        debts = order_debts(add_payoff_times(debts),
+                            strategy or fields.get('strategy') or 'payoff_time')
 
-        debt_count += 1
+    metrics.count('debts', len(debts))
+    check_budget(debts)
+    return debts
 
-    if debt_count < 2:
-        raise TooFewDebts
+MAX_DEBTS = 100
+MAX_MONTHS = 12000
 
-    if len(debt_names) < debt_count:
-        raise DuplicateNames
+def check_budget(debts):
+    """Refuse portfolios over the max_debts and max_months limits.
 
-    sorted_debts = sort_by_payoff_time(s_fields)
+    The months are the debts' stand-alone payoff times added up, which
+    bounds the work the snowball simulation has to do. Set either limit
+    to None to lift it.
+    """
+    max_debts = getattr(rc, 'max_debts', MAX_DEBTS)
+    max_months = getattr(rc, 'max_months', MAX_MONTHS)
+
+    if max_debts is not None and len(debts) > max_debts:
+        raise TooLarge
+    if max_months is not None and sum(debt['payments'] for debt in debts) > max_months:
+        raise TooLarge
+
+def compute_payoff_tables(fields):
+    """Validate the fields and return the unformatted combined payoff tables."""
+    return payoff_tables_for(ordered_debts(fields))
+
+def payoff_tables_for(debts):
+    with metrics.timed('tables'):
+        return calculate_combined_payoff_tables(debts, formatted=False,
+                                                cents=getattr(rc, 'cents', False))
+
+def target_months(target):
+    """Number of schedule months up to and including a 'YYYY-MM' month."""
+    return month_index(target, InvalidTarget) + 1
+
+def month_index(value, error):
+    """Schedule month of a 'YYYY-MM' month, raising error unless it is one
+    from this month on."""
+    try:
+        year, month = [int(part) for part in value.split('-')]
+    except (AttributeError, ValueError):
+        raise error
+    if not 1 <= month <= 12:
+        raise error
+
+    today = datetime.date.today()
+    index = (year - today.year) * 12 + month - today.month
+    if index < 0:
+        raise error
+    return index
+
+def compute_extra_payment(fields):
+    """Validate the fields and solve for the extra monthly payment that pays
+    everything off by the 'target' month, starting this month or in the
+    'extra_start' month."""
+    months = target_months(fields.get('target'))
+    extra_start = 0
+    if fields.get('extra_start'):
+        extra_start = month_index(fields['extra_start'], InvalidStart)
+    return solve_extra_payment(ordered_debts(fields), months, extra_start,
+                               cents=getattr(rc, 'cents', False))
+
+def compare_strategies(fields):
+    """Pay the debts off with every strategy and summarize each.
+
+    Payoff times are worked out once and shared, and strategies that put
+    the debts in the same order share one simulation.
+    """
+    debts = ordered_debts(fields, 'custom')
+    cents = getattr(rc, 'cents', False)
+    results = []
+
+    for strategy in STRATEGIES:
+        sorted_debts = order_debts(debts, strategy)
+        payoff_tables = calculate_combined_payoff_tables(sorted_debts, formatted=False, cents=cents)
+        summaries = [schedule_summary(debt) for debt in payoff_tables]
+        last = max(summaries, key=lambda summary: summary['months'])
+
+        results.append({'strategy': strategy,
+                        'order': [debt['debt_name'] for debt in sorted_debts],
+                        'months': last['months'],
+                        'payoff_month': last['payoff_month'],
+                        'total_interest': sum(summary['total_interest'] for summary in summaries),
+                        'total_paid': sum(summary['total_paid'] for summary in summaries)})
+
+    return results
+
+class PlanStore(object):
+    """Debts and their payoff tables saved in SQLite under short IDs.
+
+    Each debt's table is kept as its PayoffTable columns packed into BLOBs,
+    in the machine's byte order, so a store file is only for local use.
+    """
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS plans (id TEXT PRIMARY KEY, '
+                             'start_date TEXT NOT NULL, strategy TEXT NOT NULL, '
+                             'immediate_rollover INTEGER NOT NULL, cents INTEGER NOT NULL, '
+                             'debts TEXT NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS schedules (plan_id TEXT NOT NULL, '
+                             'num INTEGER NOT NULL, debt_name TEXT NOT NULL, '
+                             'typecode TEXT NOT NULL, start_balance BLOB NOT NULL, '
+                             'new_balance BLOB NOT NULL, payment BLOB NOT NULL, '
+                             'PRIMARY KEY (plan_id, num))')
+
+    def save(self, sorted_debts, payoff_tables, strategy='payoff_time', immediate_rollover=False,
+             cents=False):
+        """Save unformatted payoff tables and the debts they were made from,
+        returning the plan's ID."""
+        debts = json.dumps([{f: str(debt[f]) for f in ('debt_name', 'balance', 'payment', 'apr')}
+                            for debt in sorted_debts])
+        start_date = payoff_tables[0]['payoff_chart'].start_date if payoff_tables else \
+            datetime.date.today()
+
+        with self._lock, self._db:
+            while True:
+                plan_id = secrets.token_urlsafe(6)
+                try:
+                    self._db.execute('INSERT INTO plans VALUES (?, ?, ?, ?, ?, ?)',
+                                     (plan_id, start_date.isoformat(), strategy,
+                                      int(immediate_rollover), int(cents), debts))
+                    break
+                except sqlite3.IntegrityError: #pragma: no cover
+                    continue
+
+            self._db.executemany('INSERT INTO schedules VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 [(plan_id, num, table.debt_name, table.payment.typecode,
+                                   table.start_balance.tobytes(), table.new_balance.tobytes(),
+                                   table.payment.tobytes())
+                                  for num, table in enumerate(debt['payoff_chart']
+                                                              for debt in payoff_tables)])
+
+        return plan_id
+
+    def load(self, plan_id):
+        """The saved plan as a dict, or None if there is no such plan."""
+        with self._lock:
+            plan = self._db.execute('SELECT start_date, strategy, immediate_rollover, cents, debts '
+                                    'FROM plans WHERE id = ?', (plan_id,)).fetchone()
+            if plan is None:
+                return None
+            schedules = self._db.execute('SELECT debt_name, typecode, start_balance, new_balance, '
+                                         'payment FROM schedules WHERE plan_id = ? ORDER BY num',
+                                         (plan_id,)).fetchall()
+
+        start_date = datetime.datetime.strptime(plan[0], '%Y-%m-%d').date()
+        payoff_tables = []
+        for debt_name, typecode, start_balance, new_balance, payment in schedules:
+            table = PayoffTable(debt_name, start_date, cents=typecode == 'q')
+            table.start_balance.frombytes(start_balance)
+            table.new_balance.frombytes(new_balance)
+            table.payment.frombytes(payment)
+            payoff_tables.append({'debt_name': debt_name, 'payoff_chart': table})
+
+        debts = [{'debt_name': debt['debt_name'], 'balance': Decimal(debt['balance']),
+                  'payment': Decimal(debt['payment']), 'apr': Decimal(debt['apr'])}
+                 for debt in json.loads(plan[4])]
+
+        return {'id': plan_id, 'start_date': start_date, 'strategy': plan[1],
+                'immediate_rollover': bool(plan[2]), 'cents': bool(plan[3]), 'debts': debts,
+                'payoff_tables': payoff_tables}
+
+    def close(self):
+        self._db.close()
+
+# Opened on first use, so forked server processes each get a connection
+_plan_store = None
+
+def plan_store():
+    """The PlanStore at rc.store_path, or None when saving plans is off."""
+    global _plan_store
+    if _plan_store is None and getattr(rc, 'store_path', None):
+        _plan_store = PlanStore(rc.store_path)
+    return _plan_store
+
+def resume_plan(plan):
+    """The unformatted payoff tables of a loaded plan from this month on.
+
+    Only the months from today are simulated, starting from the saved
+    balances for this month, so the debts paid off already drop out and
+    their payments go to the rest.
+    """
+    today = datetime.date.today()
+    month = max((today.year - plan['start_date'].year) * 12 +
+                today.month - plan['start_date'].month, 0)
+
+    debts = []
+    for debt, payoff_table in zip(plan['debts'], plan['payoff_tables']):
+        table = payoff_table['payoff_chart']
+        balance = table[month].start_balance if month < len(table) else 0
+        debts.append(dict(debt, balance=balance))
+
+    return calculate_combined_payoff_tables(debts, plan['immediate_rollover'], formatted=False,
+                                            cents=plan['cents'])
+
+def save_plan(fields):
+    """Work out the payoff tables for the fields and save them, returning
+    the tables and the plan's ID."""
+    strategy = fields.get('strategy') or 'payoff_time'
+    debts = ordered_debts(fields)
+    payoff_tables = payoff_tables_for(debts)
+    cents = getattr(rc, 'cents', False)
+    return payoff_tables, plan_store().save(debts, payoff_tables, strategy, cents=cents)
+
+def plan_fields(plan):
+    """Form fields that would give plan's debts."""
+    fields = debts_to_fields([{f: str(debt[f]) for f in ('debt_name', 'balance', 'payment', 'apr')}
+                              for debt in plan['debts']])
+    fields['strategy'] = plan['strategy']
+    return fields
+
+def process_form(fields, stream=False):
+    if fields.get('save') and plan_store() is not None:
+        payoff_tables, plan_id = save_plan(fields)
+    else:
+        payoff_tables, plan_id = compute_payoff_tables(fields), None
+
+    # A streamed page renders as it is sent, after this has returned
+    with metrics.timed('render'):
+        payoff_tables = summarize_tables(payoff_tables, fields.get('view') or
+                                         getattr(rc, 'schedule_view', 'months'))
+        return render_page(fields, payoff_tables, '', stream, plan_id)
+
+def process_plan(plan_id):
+    """Render a saved plan from this month on."""
+    plan = plan_store().load(plan_id) if plan_store() is not None else None
+    if plan is None:
+        raise NotFound
+
+    fields = plan_fields(plan)
+    with metrics.timed('tables'):
+        payoff_tables = resume_plan(plan)
+
+    with metrics.timed('render'):
+        payoff_tables = summarize_tables(payoff_tables, getattr(rc, 'schedule_view', 'months'))
+        return render_page(fields, payoff_tables, plan_id=plan_id)
+
+def error_message(e):
+    if isinstance(e, MissingFields):
+        return 'All fields on a line must be filled out.'
+    elif isinstance(e, TooFewDebts):
+        return 'Two or more debts must be provided.'
+    elif isinstance(e, NegativeNumbers):
+        return 'All numbers must be positive.'
+    elif isinstance(e, DuplicateNames):
+        return 'To avoid confusion, all debts must have unique names.'
+    elif isinstance(e, RisingBalance):
+        return "Debt '%s' does not have a large enough payment to reduce the balance." % e.args[0]
+    elif isinstance(e, InvalidData):
+        return 'Debts must be a list of objects with debt_name, balance, payment, and apr.'
+    elif isinstance(e, InvalidStrategy):
+        return 'Strategy must be one of %s.' % ', '.join(STRATEGIES)
+    elif isinstance(e, InvalidTarget):
+        return 'Target must be a month, like 2030-06, by which the debts can be paid off.'
+    elif isinstance(e, InvalidStart):
+        return 'Extra payments must start in a month, like 2027-01, from this one on.'
+    elif isinstance(e, TooLarge):
+        return 'Too many debts, or debts that take too long to pay off, to calculate.'
+    elif isinstance(e, InvalidView):
+        return 'View must be one of %s.' % ', '.join(VIEWS)
+    elif isinstance(e, InvalidRange):
+        return 'Months must be given as a debt and a start and end row of its schedule.'
+    return 'Balance, payment, and APR must be numeric.'
+
+def debts_to_fields(debts):
+    """Turn a list of debt dicts into the equivalent form fields."""
+    if not isinstance(debts, list) or not all(isinstance(debt, dict) for debt in debts):
+        raise InvalidData
+
+    fields = {'row_count': str(len(debts))}
+    for num, debt in enumerate(debts, 1):
+        for f in ['debt_name', 'balance', 'payment', 'apr']:
+            value = debt.get(f, '')
+            fields["%s_%s" % (f, num)] = value if isinstance(value, str) else str(value)
+
+    return fields
+
+def _schedule_dict(row):
+    return {'month': '%d-%02d' % (row.month.year, row.month.month),
+            'start_balance': row.start_balance,
+            'new_balance': row.new_balance,
+            'payment': row.payment,
+            'paid_balance': row.paid_balance,
+            'interest_payment': row.interest_payment,
+            'principal_payment': row.principal_payment}
+
+def schedule_summary(debt):
+    """Totals for one debt of calculate_combined_payoff_tables() output."""
+    chart = debt['payoff_chart']
+    summary = {'debt_name': debt['debt_name'], 'months': len(chart), 'payoff_month': None,
+               'total_interest': sum(row.interest_payment for row in chart),
+               'total_paid': sum(row.payment for row in chart)}
+    if chart:
+        summary['payoff_month'] = _schedule_dict(chart[-1])['month']
+    return summary
+
+VIEWS = ('months', 'year', 'phase')
+
+def summary_rows(table, breaks):
+    """SummaryRows of a PayoffTable, split before each row index in breaks."""
+    if not table:
+        return []
+
+    scale = table.scale
+    bounds = [0] + [b for b in breaks if 0 < b < len(table)] + [len(table)]
+    rows = []
+
+    for start, end in zip(bounds, bounds[1:]):
+        payment = sum(table.payment[start:end])
+        interest = sum(table.new_balance[start:end]) - sum(table.start_balance[start:end])
+        rows.append(SummaryRow(table.month(start), table.month(end - 1), start, end,
+                               table.start_balance[start] / scale, payment / scale,
+                               (table.new_balance[end - 1] - table.payment[end - 1]) / scale,
+                               interest / scale, (payment - interest) / scale))
+
+    return rows
+
+def summarize_tables(payoff_tables, view='year'):
+    """Add a 'summary' of each debt's unformatted payoff_chart, totalled
+    per calendar year, or per phase between one debt being paid off and the
+    next ('phase').
+
+    Phases are bounded by the number of debts, so a page of them renders in
+    the same time however long the debts take to pay off.
+    """
+    if view not in VIEWS:
+        raise InvalidView
+    if view == 'months':
+        return payoff_tables
 
-    payoff_tables = calculate_combined_payoff_tables(sorted_debts)
+    if view == 'phase':
+        breaks = sorted(set(len(debt['payoff_chart']) for debt in payoff_tables))
 
-    return render_page(fields, payoff_tables, '')
+    results = []
+    for debt in payoff_tables:
+        table = debt['payoff_chart']
+        if view == 'year':
+            first = 12 - table.month(0).month + 1 if table else 0
+            breaks = range(first, len(table), 12)
+        # The tables may be cached, so make new dicts rather than adding to them
+        results.append(dict(debt, summary=summary_rows(table, breaks)))
 
-def render_page(fields={}, results=[], message=''):
-    template = Template(open(rc.template_file).read())
-    return template.render(fields=fields, results=results, message=message,
-                           data_ad_client=rc.data_ad_client, version=__version__)
+    return results
+
+def schedule_months(payoff_tables, debt_name, start, end):
+    """Rows start up to end of debt_name's payoff table."""
+    try:
+        start, end = int(start), int(end)
+    except (TypeError, ValueError):
+        raise InvalidRange
+
+    for debt in payoff_tables:
+        if debt['debt_name'] == debt_name:
+            if not 0 <= start < end <= len(debt['payoff_chart']):
+                raise InvalidRange
+            return [debt['payoff_chart'][index] for index in range(start, end)]
+
+    raise InvalidRange
+
+def _schedule_csv(payoff_tables):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(('debt_name',) + ScheduleRow._fields)
+
+    for debt in payoff_tables:
+        for row in debt['payoff_chart']:
+            schedule = _schedule_dict(row)
+            writer.writerow([debt['debt_name']] + [schedule[f] for f in ScheduleRow._fields])
+            if buf.tell() > 8192:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+
+    yield buf.getvalue()
+
+def api_fields(request, query=False):
+    """Form fields from an API request.
+
+    The body is either the HTML form's fields or a JSON object with a
+    'debts' list of {debt_name, balance, payment, apr} objects and an
+    optional 'strategy' and 'target'. With query, a GET can pass the
+    form's fields in the query string instead.
+    """
+    if query and request.method in ('GET', 'HEAD'):
+        fields = request.args.to_dict()
+        fields.setdefault('row_count', '0')
+        return fields
+    if request.method != 'POST':
+        raise MethodNotAllowed(['GET', 'HEAD', 'POST'] if query else ['POST'])
+
+    if request.mimetype != 'application/json':
+        fields = request.form.to_dict()
+        fields.setdefault('row_count', '0')
+        return fields
+
+    try:
+        body = json.loads(request.get_data(as_text=True))
+    except ValueError:
+        raise InvalidData
+    if not isinstance(body, dict):
+        raise InvalidData
+
+    fields = debts_to_fields(body.get('debts'))
+    for f in ['strategy', 'target', 'extra_start', 'view', 'debt', 'start', 'end', 'plan']:
+        if body.get(f) is not None:
+            fields[f] = str(body[f])
+
+    return fields
+
+def api_error(e):
+    metrics.count('errors', type=e.__class__.__name__)
+    return Response(json.dumps({'error': error_message(e)}), status=400,
+                    mimetype='application/json')
+
+def api_schedule(request):
+    """Return the combined payoff tables as JSON, or CSV with ?format=csv."""
+    csv_format = request.args.get('format') == 'csv'
+    try:
+        debts = ordered_debts(api_fields(request, query=True))
+    except INPUT_ERRORS as e:
+        return api_error(e)
+
+    # Only a GET can be answered from the client's copy, so POSTs get no ETag
+    etag = None
+    if request.method in ('GET', 'HEAD'):
+        etag = input_etag('schedule', csv_format, [_debt_key(debt) for debt in debts])
+        response = check_etag(request, etag)
+        if response is not None:
+            return response
+
+    payoff_tables = payoff_tables_for(debts)
+
+    if csv_format:
+        response = Response(_schedule_csv(payoff_tables), mimetype='text/csv')
+    else:
+        response = Response(json.dumps({'debts': [{'debt_name': debt['debt_name'],
+                                                   'payoff_chart': [_schedule_dict(row)
+                                                                    for row in debt['payoff_chart']]}
+                                                  for debt in payoff_tables]}),
+                            mimetype='application/json')
+
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+def input_etag(*key):
+    """ETag for a response that only depends on key.
+
+    Being taken from the normalized input rather than the output, it can be
+    checked before doing any work. Schedules start today, so the date is
+    part of it, as is everything in the config that changes the output
+    and the templates' modification times.
+    """
+    key = (__version__, datetime.date.today(), rc.data_ad_client, rc.base_path,
+           getattr(rc, 'cents', False), getattr(rc, 'schedule_view', 'months'),
+           bool(getattr(rc, 'store_path', None)), _template_mtimes()) + key
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def _template_mtimes():
+    template_dir = os.path.dirname(os.path.abspath(rc.template_file))
+    return tuple(os.path.getmtime(os.path.join(template_dir, name))
+                 for name in (os.path.basename(rc.template_file), ROWS_TEMPLATE))
+
+def check_etag(request, etag):
+    """Answer a GET or HEAD whose If-None-Match has etag with a 304, or
+    return None."""
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    return None
+
+def not_modified(etag):
+    metrics.count('not_modified')
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+def _gzip_stream(chunks):
+    # Flush after every chunk so a streamed page still arrives as it renders
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+# Content encodings, best first
+ENCODINGS = OrderedDict()
+if brotli is not None:
+    ENCODINGS['br'] = brotli.compress
+ENCODINGS['gzip'] = lambda data: gzip.compress(data, 6)
+
+# Compressed bodies of responses with an ETag, by (ETag, encoding)
+compressed_cache = ResultCache(maxsize=32)
+
+def compress_response(request, response):
+    """Compress response with the best encoding the client accepts.
+
+    Streamed responses can only be gzipped, and bodies smaller than
+    compress_min_size are sent as they are.
+    """
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if response.is_streamed:
+        if request.accept_encodings.best_match(['gzip']):
+            response.response = _gzip_stream(response.iter_encoded())
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    encoding = request.accept_encodings.best_match(list(ENCODINGS))
+    data = response.get_data()
+    if encoding is None or len(data) < getattr(rc, 'compress_min_size', 1024):
+        return response
+
+    etag, weak = response.get_etag()
+    if etag:
+        data = compressed_cache.get((etag, encoding), lambda: ENCODINGS[encoding](data))
+    else:
+        data = ENCODINGS[encoding](data)
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def api_months(request):
+    """Return rows 'start' up to 'end' of the schedule of the debt named
+    'debt' as JSON, or with ?format=html as table rows for the page.
+
+    The schedule is the posted debts', or with 'plan' the saved plan's from
+    this month on, as its page shows it.
+    """
+    try:
+        fields = api_fields(request)
+        if fields.get('plan'):
+            plan = plan_store().load(fields['plan']) if plan_store() is not None else None
+            if plan is None:
+                raise NotFound
+            with metrics.timed('tables'):
+                payoff_tables = resume_plan(plan)
+        else:
+            payoff_tables = compute_payoff_tables(fields)
+        rows = schedule_months(payoff_tables, fields.get('debt'),
+                               fields.get('start'), fields.get('end'))
+    except INPUT_ERRORS as e:
+        return api_error(e)
+
+    if request.args.get('format') == 'html':
+        return Response(render_rows(rows), mimetype='text/html')
+
+    return Response(json.dumps({'debt_name': fields['debt'],
+                                'payoff_chart': [_schedule_dict(row) for row in rows]}),
+                    mimetype='application/json')
+
+def api_plans(request, plan_id=None):
+    """Save the posted debts' plan and return its ID, or return the schedule
+    of the saved plan plan_id from this month on."""
+    if plan_store() is None:
+        raise NotFound
+
+    if plan_id is None:
+        try:
+            payoff_tables, plan_id = save_plan(api_fields(request))
+        except INPUT_ERRORS as e:
+            return api_error(e)
+        return Response(json.dumps({'id': plan_id}), mimetype='application/json')
+
+    if request.method != 'GET':
+        raise MethodNotAllowed(['GET'])
+
+    plan = plan_store().load(plan_id)
+    if plan is None:
+        raise NotFound
+
+    return Response(json.dumps({'id': plan_id, 'strategy': plan['strategy'],
+                                'start_date': plan['start_date'].isoformat(),
+                                'debts': [{'debt_name': debt['debt_name'],
+                                           'payoff_chart': [_schedule_dict(row)
+                                                            for row in debt['payoff_chart']]}
+                                          for debt in resume_plan(plan)]}),
+                    mimetype='application/json')
+
+def api_compare(request):
+    """Return compare_strategies() for the posted debts as JSON."""
+    try:
+        strategies = compare_strategies(api_fields(request))
+    except INPUT_ERRORS as e:
+        return api_error(e)
+
+    return Response(json.dumps({'strategies': strategies}), mimetype='application/json')
+
+def api_extra(request):
+    """Return the extra monthly payment needed to be debt free by 'target'."""
+    try:
+        fields = api_fields(request)
+        extra_payment = compute_extra_payment(fields)
+    except INPUT_ERRORS as e:
+        return api_error(e)
+
+    return Response(json.dumps({'target': fields['target'], 'extra_payment': extra_payment}),
+                    mimetype='application/json')
+
+def _template_environment():
+    # Compiled templates stay cached in the environment; they are only
+    # checked for changes on disk in debug mode.
+    template_dir = os.path.dirname(os.path.abspath(rc.template_file))
+    env = Environment(loader=FileSystemLoader(template_dir), auto_reload=rc.debug,
+                      bytecode_cache=_bytecode_cache(template_dir))
+    env.filters['money'] = money_fmt
+    return env
+
+def _bytecode_cache(template_dir):
+    """Cache of compiled templates in rc.bytecode_cache_dir, or by default
+    in .template_cache next to the templates, so it isn't shared with other
+    apps. None when the directory can't be made."""
+    directory = getattr(rc, 'bytecode_cache_dir', None) or os.path.join(template_dir,
+                                                                        '.template_cache')
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return FileSystemBytecodeCache(directory)
+
+template_env = _template_environment()
+
+# Month rows of a schedule, next to rc.template_file, which includes it
+ROWS_TEMPLATE = 'debt_snowball_rows.html.j2'
+
+def load_template():
+    return template_env.get_template(os.path.basename(rc.template_file))
+
+# The empty form, which only changes with the template
+empty_page = None
+
+def render_page(fields={}, results=[], message='', stream=False, plan_id=None):
+    """Render the page, or with stream return an iterable of chunks to send
+    as the template renders."""
+    global empty_page
+    empty = not (fields or results or message or stream or plan_id or rc.debug)
+    if empty and empty_page is not None:
+        return empty_page
+
+    template = load_template()
+    context = {'fields': fields, 'results': results, 'message': message,
+               'view': fields.get('view') or getattr(rc, 'schedule_view', 'months'),
+               'plan_id': plan_id, 'saving': bool(getattr(rc, 'store_path', None)),
+               'data_ad_client': rc.data_ad_client,
+               'api_path': rc.base_path.rstrip('/') + '/api/', 'version': __version__}
+
+    if stream:
+        chunks = template.stream(**context)
+        chunks.enable_buffering(64)
+        return chunks
+
+    page = template.render(**context)
+    if empty:
+        empty_page = page
+    return page
+
+def render_rows(rows):
+    """Render schedule rows the way the page shows them."""
+    return template_env.get_template(ROWS_TEMPLATE).render(rows=rows)
+
+def read_portfolios(path):
+    """Yield (portfolio id, debts) pairs from a batch input file.
+
+    .csv files have id, debt_name, balance, payment and apr columns with the
+    rows of a portfolio next to each other. Anything else is read as JSON
+    lines of {"id": ..., "debts": [...]} objects. A line that isn't one
+    gives an id and debts of None, so it comes out as an error.
+    """
+    with open(path, newline='') as input_file:
+        if path.endswith('.csv'):
+            rows = csv.DictReader(input_file)
+            for portfolio_id, debts in itertools.groupby(rows, lambda row: row['id']):
+                yield portfolio_id, [dict(debt) for debt in debts]
+        else:
+            for line in input_file:
+                if line.strip():
+                    try:
+                        portfolio = json.loads(line)
+                    except ValueError:
+                        portfolio = None
+                    if isinstance(portfolio, dict):
+                        yield portfolio.get('id'), portfolio.get('debts')
+                    else:
+                        yield None, None
+
+def run_portfolio(portfolio, schedules=False):
+    """Validate and pay down one batch portfolio, returning a JSON-able dict."""
+    portfolio_id, debts = portfolio
+
+    try:
+        payoff_tables = compute_payoff_tables(debts_to_fields(debts))
+    except INPUT_ERRORS as e:
+        return {'id': portfolio_id, 'error': error_message(e)}
+
+    result = {'id': portfolio_id, 'debts': [schedule_summary(debt) for debt in payoff_tables]}
+    if schedules:
+        for summary, debt in zip(result['debts'], payoff_tables):
+            summary['payoff_chart'] = [_schedule_dict(row) for row in debt['payoff_chart']]
+
+    return result
+
+def run_batch(input_path, output_file, workers=None, schedules=False):
+    """Run every portfolio in input_path and write one JSON line per result,
+    in input order, to output_file. Returns the number of portfolios."""
+    portfolios = read_portfolios(input_path)
+
+    if workers == 1:
+        return _write_results(output_file, (run_portfolio(portfolio, schedules)
+                                            for portfolio in portfolios))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        window = 2 * (workers or os.cpu_count() or 1)
+        return _write_results(output_file, _pooled_results(executor, portfolios, schedules, window))
+
+# Portfolios sent to a batch worker at a time
+BATCH_CHUNK = 64
+
+def _run_chunk(chunk, schedules):
+    return [run_portfolio(portfolio, schedules) for portfolio in chunk]
+
+def _pooled_results(executor, portfolios, schedules, window):
+    # Keep at most window chunks in flight, so the input is read and the
+    # results are written as the batch goes instead of all held at once
+    pending = deque()
+    for chunk in iter(lambda: list(itertools.islice(portfolios, BATCH_CHUNK)), []):
+        pending.append(executor.submit(_run_chunk, chunk, schedules))
+        if len(pending) >= window:
+            yield from pending.popleft().result()
+
+    while pending:
+        yield from pending.popleft().result()
+
+def _write_results(output_file, results):
+    count = 0
+    for result in results:
+        output_file.write(json.dumps(result) + '\n')
+        count += 1
+    return count
+
+# Compile the template once, when the WSGI app is loaded
+load_template()
 
 @Request.application
 def application(request):
+    metrics.start_request()
+
+    with metrics.timed('request'):
+        response = dispatch(request)
+
+    metrics.count('requests')
+
+    if getattr(rc, 'compress', True) and not isinstance(response, HTTPException):
+        response = compress_response(request, response)
+
+    if getattr(rc, 'server_timing', False):
+        if isinstance(response, HTTPException):
+            response = response.get_response(request.environ)
+        response.headers['Server-Timing'] = metrics.server_timing()
+
+    return response
+
+def api_metrics(request):
+    if not metrics.served:
+        raise NotFound
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+def dispatch(request):
 
     response = Response(mimetype='text/html')
 
     try:
+        path = urlparse(request.url).path
+        api_path = rc.base_path.rstrip('/') + '/api/'
+
+        if path == rc.base_path.rstrip('/') + '/metrics':
+            return api_metrics(request)
+        elif path == api_path + 'schedule':
+            return api_schedule(request)
+        elif path == api_path + 'plans':
+            return api_plans(request)
+        elif path.startswith(api_path + 'plans/'):
+            return api_plans(request, path[len(api_path + 'plans/'):])
+        elif path == api_path + 'months':
+            return api_months(request)
+        elif path == api_path + 'compare':
+            return api_compare(request)
+        elif path == api_path + 'extra':
+            return api_extra(request)
+
         # Only accept requests for rc.base_path
-        if urlparse(request.url).path != rc.base_path:
+        if path != rc.base_path:
             raise NotFound
 
         fields = request.form.to_dict()
 
+        if request.method not in ('GET', 'POST'):
+            raise BadRequest
+
+        # A GET page only depends on the saved plan asked for. Results are
+        # POSTed, and a POST can't be answered from the client's copy.
+        plan_id = request.args.get('plan')
         if request.method == 'GET':
+            etag = input_etag('page', plan_id)
+            cached = check_etag(request, etag)
+            if cached is not None:
+                return cached
+            response.set_etag(etag, weak=True)
+
+        if request.method == 'GET' and plan_id:
+            response.data = process_plan(plan_id)
+        elif request.method == 'GET' or not request.form:
             raise NoFormData
-        elif request.method == 'POST':
-            if not request.form:
-                raise NoFormData
+        elif getattr(rc, 'stream_response', False):
+            response.response = process_form(fields, stream=True)
         else:
-            raise BadRequest
-
-        response.data = process_form(fields)
+            response.data = process_form(fields)
 
     except NoFormData as e:
         response.data = render_page()
 
-    except MissingFields as e:
-        response.data = render_page(fields=fields,
-                                    message='All fields on a line must be filled out.')
+    except INPUT_ERRORS as e:
+        metrics.count('errors', type=e.__class__.__name__)
+        response.data = render_page(fields=fields, message=error_message(e))
 
-    except TooFewDebts as e:
-        response.data = render_page(fields=fields,
-                                    message='Two or more debts must be provided.')
+    except HTTPException as e:
+        return e
 
-    except NegativeNumbers as e:
-        response.data = render_page(fields=fields,
-                                    message='All numbers must be positive.')
+    return response
 
-    except DuplicateNames as e:
-        response.data = render_page(fields=fields,
-                                    message='To avoid confusion, all debts must have unique names.')
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server handling requests on a fixed pool of threads."""
+    multithread = True
 
-    except RisingBalance as e:
-        response.data = render_page(fields=fields,
-                                    message="Debt '%s' does not have a large enough payment to reduce the balance." % e.args[0])
+    def __init__(self, host, port, app, threads=8, **kwargs):
+        BaseWSGIServer.__init__(self, host, port, app, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
 
-    except ValueError as e:
-        response.data = render_page(fields=fields,
-                                    message='Balance, payment, and APR must be numeric.')
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
 
-    except HTTPException as e:
-        return e
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
 
-    return response
+    def server_close(self):
+        BaseWSGIServer.server_close(self)
+        self.pool.shutdown()
+
+def serve(host='127.0.0.1', port=8000, threads=1, processes=1, simulation_workers=0):
+    """Serve application with a pool of threads or forked processes, and
+    optionally a pool of simulation_workers processes for the snowball.
+
+    The simulation pool belongs to the serving process, so it can't be
+    combined with forked processes, which would each start their own.
+    """
+    if threads > 1 and processes > 1:
+        raise ValueError('Serve with either threads or processes, not both')
+    if processes > 1 and simulation_workers:
+        raise ValueError('Simulation workers can only be used with threads')
+
+    metrics.served = processes == 1
+    if simulation_workers:
+        start_simulation_pool(simulation_workers)
+
+    try:
+        if threads > 1:
+            server = PooledWSGIServer(host, port, application, threads=threads)
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+        else:
+            run_simple(host, port, application, use_debugger=False, use_reloader=False,
+                       passthrough_errors=True, threaded=False, processes=processes)
+    finally:
+        stop_simulation_pool()
 
 if __name__ == '__main__': #pragma: no cover
-    from werkzeug.serving import run_simple
-    if sys.argv[1:]:
-        port = int(sys.argv[1])
-    else:
-        port = 8000
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Debt snowball calculator')
+    parser.add_argument('port', nargs='?', type=int, default=8000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='handle requests on a pool of this many threads')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='handle requests in this many forked processes; '
+                             'metrics are per process, so /metrics is not served')
+    parser.add_argument('--sim-workers', type=int, default=0,
+                        help='run snowball simulations in a pool of this many processes')
+    parser.add_argument('--max-debts', type=int,
+                        help='most debts accepted in one request (default %d)' % MAX_DEBTS)
+    parser.add_argument('--max-months', type=int,
+                        help='most payoff months, over all debts, accepted in one request '
+                             '(default %d)' % MAX_MONTHS)
+    parser.add_argument('--batch', metavar='INPUT',
+                        help='pay down the portfolios in a .csv or JSON lines file instead of serving')
+    parser.add_argument('--output', metavar='OUTPUT', default='-',
+                        help='JSON lines file for batch results (default: stdout)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='batch worker processes (default: one per CPU)')
+    parser.add_argument('--schedules', action='store_true',
+                        help='include the month by month schedules in batch results')
+    args = parser.parse_args()
+
+    if args.batch:
+        if args.output == '-':
+            run_batch(args.batch, sys.stdout, args.workers, args.schedules)
+        else:
+            with open(args.output, 'w') as output_file:
+                run_batch(args.batch, output_file, args.workers, args.schedules)
+        sys.exit(0)
+
+    if args.max_debts is not None:
+        rc.max_debts = args.max_debts
+    if args.max_months is not None:
+        rc.max_months = args.max_months
+
+    if args.threads > 1 and args.processes > 1:
+        parser.error('--threads and --processes can not be combined')
+    if args.processes > 1 and args.sim_workers:
+        parser.error('--sim-workers can only be combined with --threads')
 
-    print("Serving on port %s" % port)
+    print("Serving on port %s" % args.port)
 
-    run_simple('127.0.0.1', port, application, use_debugger=False, use_reloader=False,
-               passthrough_errors=True, threaded=False)
+    serve(args.host, args.port, args.threads, args.processes, args.sim_workers)
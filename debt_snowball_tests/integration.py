@@ -1,4 +1,14 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
 import unittest
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
@@ -20,6 +30,40 @@ class TestWebResponses(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('Snowball debt paydown', resp.data.decode('utf-8'))
 
+    def test_metrics(self):
+        """Timings and counters are served as Prometheus text"""
+        self.c.post('/', data={'row_count': '1', 'debt_name_1': 'test_name',
+                               'balance_1': '0', 'payment_1': '0', 'apr_1':'5.3'})
+        resp = self.c.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        data = resp.data.decode('utf-8')
+        self.assertIn('debtsnowball_stage_seconds_count{stage="parse"}', data)
+        self.assertIn('debtsnowball_errors_total{type="TooFewDebts"}', data)
+
+        ds.metrics.served = False
+        try:
+            self.assertEqual(self.c.get('/metrics').status_code, 404)
+        finally:
+            ds.metrics.served = True
+
+    def test_server_timing(self):
+        """Optionally send the request's timings in a Server-Timing header"""
+        self.assertNotIn('Server-Timing', self.c.get('/').headers)
+        server_timing = getattr(ds.rc, 'server_timing', False)
+        ds.rc.server_timing = True
+        try:
+            resp = self.c.post('/', data={'row_count': '2',
+                                          'debt_name_1': 'debt a', 'balance_1':'10000',
+                                          'payment_1': '200', 'apr_1': '12',
+                                          'debt_name_2': 'debt b', 'balance_2':'10000',
+                                          'payment_2': '300', 'apr_2': '12'})
+            self.assertRegex(resp.headers['Server-Timing'],
+                             r'^parse;dur=[0-9.]+, sort;dur=[0-9.]+, tables;dur=[0-9.]+, '
+                             r'render;dur=[0-9.]+, request;dur=[0-9.]+$')
+            self.assertIn('Server-Timing', self.c.get('/favicon.ico').headers)
+        finally:
+            ds.rc.server_timing = server_timing
+
     def test_invalid_method(self):
         """Test an invalid method"""
         resp = self.c.head('/')
@@ -87,3 +131,333 @@ class TestWebResponses(unittest.TestCase):
         self.assertIn('$222.73', data)
         self.assertIn('$250.55', data)
         self.assertIn('$502.83', data)
+
+    def test_summary_view(self):
+        """The summary views show fewer rows, each able to fetch its months"""
+        data = {'row_count': '2',
+                'debt_name_1': 'debt a', 'balance_1':'10000', 'payment_1': '200', 'apr_1': '12',
+                'debt_name_2': 'debt b', 'balance_2':'10000', 'payment_2': '300', 'apr_2': '12'}
+        months = self.c.post('/', data=data).data.decode('utf-8')
+        data['view'] = 'phase'
+        phases = self.c.post('/', data=data).data.decode('utf-8')
+        self.assertEqual(phases.count('onclick="showMonths(this)"'), 3)
+        self.assertLess(phases.count('<tr>'), months.count('<tr>'))
+        self.assertIn('<option value="phase" selected>', phases)
+
+    def test_summary_debt_name(self):
+        """Debt names are escaped in the summary rows' buttons"""
+        data = {'row_count': '2', 'view': 'phase',
+                'debt_name_1': 'a "b" <c>', 'balance_1':'10000', 'payment_1': '200', 'apr_1': '12',
+                'debt_name_2': 'debt b', 'balance_2':'10000', 'payment_2': '300', 'apr_2': '12'}
+        page = self.c.post('/', data=data).data.decode('utf-8')
+        self.assertIn('data-debt="a &#34;b&#34; &lt;c&gt;"', page)
+
+    def test_streamed_run(self):
+        """A streamed response should match the buffered one"""
+        data = {'row_count': '2',
+                'debt_name_1': 'debt a', 'balance_1':'10000',
+                'payment_1': '200', 'apr_1': '12',
+                'debt_name_2': 'debt b', 'balance_2':'10000',
+                'payment_2': '300', 'apr_2': '12'}
+        buffered = self.c.post('/', data=data).data
+        stream_response = getattr(ds.rc, 'stream_response', False)
+        ds.rc.stream_response = True
+        try:
+            resp = self.c.post('/', data=data)
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(buffered, resp.data)
+        finally:
+            ds.rc.stream_response = stream_response
+
+class TestCaching(unittest.TestCase):
+    data = {'row_count': '2',
+            'debt_name_1': 'debt a', 'balance_1':'10000', 'payment_1': '200', 'apr_1': '12',
+            'debt_name_2': 'debt b', 'balance_2':'10000', 'payment_2': '300', 'apr_2': '12'}
+
+    def setUp(self):
+        self.c = Client(ds.application, BaseResponse)
+
+    def test_gzip(self):
+        """Pages are gzipped for clients that accept it"""
+        plain = self.c.post('/', data=self.data)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        resp = self.c.post('/', data=self.data, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+    def test_streamed_gzip(self):
+        """Streamed pages are gzipped as they render"""
+        plain = self.c.post('/', data=self.data)
+        stream_response = getattr(ds.rc, 'stream_response', False)
+        ds.rc.stream_response = True
+        try:
+            resp = self.c.post('/', data=self.data, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(resp.data), plain.data)
+        finally:
+            ds.rc.stream_response = stream_response
+
+    def test_not_modified(self):
+        """A page the client already has isn't sent again"""
+        etag = self.c.get('/').headers['ETag']
+        self.assertEqual(self.c.get('/', headers={'If-None-Match': etag}).status_code, 304)
+
+        resp = self.c.post('/', data=self.data, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_config_etag(self):
+        """Config and templates that change the page change its ETag"""
+        etag = self.c.get('/').headers['ETag']
+        schedule_view = getattr(ds.rc, 'schedule_view', 'months')
+        ds.rc.schedule_view = 'year'
+        try:
+            self.assertNotEqual(self.c.get('/').headers['ETag'], etag)
+        finally:
+            ds.rc.schedule_view = schedule_view
+
+        mtime = os.path.getmtime(ds.rc.template_file)
+        os.utime(ds.rc.template_file, (mtime + 1, mtime + 1))
+        try:
+            self.assertNotEqual(self.c.get('/').headers['ETag'], etag)
+        finally:
+            os.utime(ds.rc.template_file, (mtime, mtime))
+
+    def test_schedule_etag(self):
+        """Schedule ETags come from the normalized debts"""
+        query = {'row_count': '2',
+                 'debt_name_1': 'debt a', 'balance_1':'10000', 'payment_1': '200', 'apr_1': '12',
+                 'debt_name_2': 'debt b', 'balance_2':'10000', 'payment_2': '300', 'apr_2': '12'}
+        etag = self.c.get('/api/schedule', query_string=query).headers['ETag']
+        query['balance_1'] = '10,000.00'
+        resp = self.c.get('/api/schedule', query_string=query, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.c.post('/api/schedule', data=query, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('ETag', resp.headers)
+
+class TestPlans(unittest.TestCase):
+    debts = [{'debt_name': 'debt a', 'balance': 10000, 'payment': 200, 'apr': 12},
+             {'debt_name': 'debt b', 'balance': 10000, 'payment': 300, 'apr': 12}]
+
+    def setUp(self):
+        self.c = Client(ds.application, BaseResponse)
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.store_path = getattr(ds.rc, 'store_path', None)
+        ds.rc.store_path = self.path
+        ds._plan_store = None
+
+    def tearDown(self):
+        ds.plan_store().close()
+        ds._plan_store = None
+        ds.rc.store_path = self.store_path
+        os.remove(self.path)
+
+    def test_api(self):
+        """Save a plan and load its schedule by ID"""
+        resp = self.c.post('/api/plans', data=json.dumps({'debts': self.debts}),
+                           content_type='application/json')
+        plan_id = json.loads(resp.data.decode('utf-8'))['id']
+        resp = self.c.get('/api/plans/' + plan_id)
+        plan = json.loads(resp.data.decode('utf-8'))
+        schedule = self.c.post('/api/schedule', data=json.dumps({'debts': self.debts}),
+                               content_type='application/json')
+        self.assertEqual(plan['debts'], json.loads(schedule.data.decode('utf-8'))['debts'])
+        self.assertEqual(self.c.get('/api/plans/nosuchid').status_code, 404)
+
+    def test_paid_off_summary(self):
+        """A saved plan with a paid off debt shows in the summary view"""
+        debts = self.debts + [{'debt_name': 'debt c', 'balance': 0, 'payment': 50, 'apr': 5}]
+        resp = self.c.post('/api/plans', data=json.dumps({'debts': debts}),
+                           content_type='application/json')
+        plan_id = json.loads(resp.data.decode('utf-8'))['id']
+        schedule_view = getattr(ds.rc, 'schedule_view', 'months')
+        ds.rc.schedule_view = 'phase'
+        try:
+            resp = self.c.get('/?plan=' + plan_id)
+        finally:
+            ds.rc.schedule_view = schedule_view
+        self.assertEqual(resp.status_code, 200)
+
+    def test_page(self):
+        """Save a plan from the page and come back to it"""
+        data = {'row_count': '2', 'save': '1',
+                'debt_name_1': 'debt a', 'balance_1':'10000', 'payment_1': '200', 'apr_1': '12',
+                'debt_name_2': 'debt b', 'balance_2':'10000', 'payment_2': '300', 'apr_2': '12'}
+        page = self.c.post('/', data=data).data.decode('utf-8')
+        plan_id = page.split('?plan=')[1].split('"')[0]
+        resp = self.c.get('/?plan=' + plan_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('debt b', resp.data.decode('utf-8'))
+        self.assertEqual(self.c.get('/?plan=nosuchid').status_code, 404)
+
+    def test_months(self):
+        """Months of a saved plan come from its schedule from this month on"""
+        resp = self.c.post('/api/plans', data=json.dumps({'debts': self.debts}),
+                           content_type='application/json')
+        plan_id = json.loads(resp.data.decode('utf-8'))['id']
+        start_date = datetime.date.today().replace(day=1, year=datetime.date.today().year - 1)
+        with ds.plan_store()._db:
+            ds.plan_store()._db.execute('UPDATE plans SET start_date = ? WHERE id = ?',
+                                        (start_date.isoformat(), plan_id))
+
+        resp = self.c.post('/api/months', data={'plan': plan_id, 'debt': 'debt a',
+                                                'start': '0', 'end': '2'})
+        months = json.loads(resp.data.decode('utf-8'))['payoff_chart']
+        table = [debt['payoff_chart'] for debt in ds.resume_plan(ds.plan_store().load(plan_id))
+                 if debt['debt_name'] == 'debt a'][0]
+        self.assertEqual(months, [ds._schedule_dict(table[0]), ds._schedule_dict(table[1])])
+        self.assertLess(months[0]['start_balance'], 10000)
+
+        resp = self.c.post('/api/months', data={'plan': 'nosuchid', 'debt': 'debt a',
+                                                'start': '0', 'end': '2'})
+        self.assertEqual(resp.status_code, 404)
+
+class TestPooledServer(unittest.TestCase):
+    def test_concurrent_requests(self):
+        """The pooled server answers requests from several clients at once"""
+        server = ds.PooledWSGIServer('127.0.0.1', 0, ds.application, threads=4)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d%s' % (server.server_port, ds.rc.base_path)
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                pages = list(pool.map(lambda i: urllib.request.urlopen(url).read(), range(8)))
+            for page in pages:
+                self.assertIn('Snowball debt paydown', page.decode('utf-8'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+class TestScheduleApi(unittest.TestCase):
+    debts = [{'debt_name': 'debt a', 'balance': 10000, 'payment': 200, 'apr': 12},
+             {'debt_name': 'debt b', 'balance': '$10,000', 'payment': '300', 'apr': '12%'},
+             {'debt_name': 'debt c', 'balance': 10000, 'payment': 150, 'apr': 12}]
+
+    def setUp(self):
+        self.c = Client(ds.application, BaseResponse)
+
+    def test_json(self):
+        """Get the payoff tables as JSON"""
+        resp = self.c.post('/api/schedule', data=json.dumps({'debts': self.debts}),
+                           content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'application/json')
+        results = json.loads(resp.data.decode('utf-8'))['debts']
+        self.assertEqual(['debt b', 'debt a', 'debt c'], [r['debt_name'] for r in results])
+        self.assertAlmostEqual(results[2]['payoff_chart'][-1]['start_balance'], 502.83, places=2)
+        self.assertEqual(results[2]['payoff_chart'][-1]['paid_balance'], 0)
+
+    def test_form_csv(self):
+        """Post the HTML form fields and get CSV back"""
+        resp = self.c.post('/api/schedule?format=csv',
+                           data={'row_count': '2',
+                                 'debt_name_1': 'debt, a', 'balance_1': '10000',
+                                 'payment_1': '200', 'apr_1': '12',
+                                 'debt_name_2': 'debt b', 'balance_2': '10000',
+                                 'payment_2': '300', 'apr_2': '12'})
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/csv'))
+        rows = list(csv.reader(io.StringIO(resp.data.decode('utf-8'))))
+        self.assertEqual(rows[0][:3], ['debt_name', 'month', 'start_balance'])
+        self.assertEqual(rows[-1][0], 'debt, a')
+
+    def test_errors(self):
+        """Validation errors come back as JSON"""
+        resp = self.c.post('/api/schedule', data=json.dumps({'debts': self.debts[:1]}),
+                           content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.data.decode('utf-8')),
+                         {'error': 'Two or more debts must be provided.'})
+
+        resp = self.c.post('/api/schedule', data=json.dumps({'debts': 'debt a'}),
+                           content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('must be a list', json.loads(resp.data.decode('utf-8'))['error'])
+
+    def test_strategy(self):
+        """Pick the payoff order"""
+        resp = self.c.post('/api/schedule', data=json.dumps({'debts': self.debts, 'strategy': 'custom'}),
+                           content_type='application/json')
+        results = json.loads(resp.data.decode('utf-8'))['debts']
+        self.assertEqual(['debt a', 'debt b', 'debt c'], [r['debt_name'] for r in results])
+
+        resp = self.c.post('/api/schedule', data=json.dumps({'debts': self.debts, 'strategy': 'x'}),
+                           content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('Strategy must be one of', json.loads(resp.data.decode('utf-8'))['error'])
+
+    def test_compare(self):
+        """Compare all the strategies in one request"""
+        resp = self.c.post('/api/compare', data=json.dumps({'debts': self.debts}),
+                           content_type='application/json')
+        strategies = json.loads(resp.data.decode('utf-8'))['strategies']
+        self.assertEqual([s['strategy'] for s in strategies], list(ds.STRATEGIES))
+        self.assertEqual(strategies[0]['order'], ['debt b', 'debt a', 'debt c'])
+        self.assertIn('payoff_month', strategies[0])
+
+    def test_extra(self):
+        """Solve for the extra payment needed to meet a target"""
+        target = datetime.date.today().year + 3
+        resp = self.c.post('/api/extra', data=json.dumps({'debts': self.debts,
+                                                          'target': '%d-01' % target}),
+                           content_type='application/json')
+        result = json.loads(resp.data.decode('utf-8'))
+        self.assertEqual(result['target'], '%d-01' % target)
+        self.assertGreater(result['extra_payment'], 0)
+
+        resp = self.c.post('/api/extra', data=json.dumps({'debts': self.debts,
+                                                          'target': '%d-01' % target,
+                                                          'extra_start': '%d-01' % (target - 1)}),
+                           content_type='application/json')
+        later = json.loads(resp.data.decode('utf-8'))
+        self.assertGreater(later['extra_payment'], result['extra_payment'])
+
+        resp = self.c.post('/api/extra', data=json.dumps({'debts': self.debts,
+                                                          'target': '%d-01' % target,
+                                                          'extra_start': '2000-01'}),
+                           content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('Extra payments must start', json.loads(resp.data.decode('utf-8'))['error'])
+
+        resp = self.c.post('/api/extra', data=json.dumps({'debts': self.debts}),
+                           content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('Target must be a month', json.loads(resp.data.decode('utf-8'))['error'])
+
+    def test_months(self):
+        """Fetch some months of one debt's schedule"""
+        body = json.dumps({'debts': self.debts, 'debt': 'debt a', 'start': 0, 'end': 3})
+        resp = self.c.post('/api/months', data=body, content_type='application/json')
+        result = json.loads(resp.data.decode('utf-8'))
+        self.assertEqual(result['debt_name'], 'debt a')
+        self.assertEqual(len(result['payoff_chart']), 3)
+
+        resp = self.c.post('/api/months?format=html', data=body, content_type='application/json')
+        self.assertEqual(resp.data.decode('utf-8').count('<tr>'), 3)
+
+        body = json.dumps({'debts': self.debts, 'debt': 'debt a', 'start': 0, 'end': 1000})
+        resp = self.c.post('/api/months', data=body, content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_compare_budget(self):
+        """Comparing strategies keeps to the debt budget"""
+        max_debts = getattr(ds.rc, 'max_debts', None)
+        ds.rc.max_debts = 1
+        try:
+            resp = self.c.post('/api/compare', data=json.dumps({'debts': self.debts}),
+                               content_type='application/json')
+        finally:
+            ds.rc.max_debts = max_debts
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('Too many debts', json.loads(resp.data.decode('utf-8'))['error'])
+
+    def test_get(self):
+        """Only the schedule API takes gets"""
+        resp = self.c.get('/api/compare')
+        self.assertEqual(resp.status_code, 405)
+        resp = self.c.get('/api/schedule', query_string={'row_count': '0'})
+        self.assertEqual(resp.status_code, 400)
@@ -1,6 +1,10 @@
 import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
+import io
+import json
+import os
+import tempfile
 import unittest
 
 import debt_snowball as ds
@@ -23,6 +27,133 @@ class TestAmortization(unittest.TestCase):
         result = ds.do_amortization('dummy', '95113.31', '1111.67', '5.375', additional_start, 1000)
         self.assertEqual(result[-1]['start_balance'], ds.money_fmt(1205.32))
 
+class TestIterAmortization(unittest.TestCase):
+    def test_numeric_rows(self):
+        """Rows come out unformatted and match do_amortization once formatted"""
+        rows = list(ds.iter_amortization('dummy', '95113.31', '1111.67', '5.375'))
+        self.assertEqual(len(rows), 109)
+        self.assertIsInstance(rows[-1].start_balance, float)
+        self.assertEqual(ds.money_fmt(rows[-1].start_balance), ds.money_fmt(147.32))
+        self.assertEqual(ds.do_amortization('dummy', '95113.31', '1111.67', '5.375'),
+                         [ds._format_row(row) for row in rows])
+
+    def test_lazy(self):
+        """Only the rows asked for are computed"""
+        rows = ds.iter_amortization('dummy', '95113.31', '1111.67', '5.375')
+        self.assertEqual(next(rows).start_balance, 95113.31)
+
+class TestPayoffTable(unittest.TestCase):
+    def test_rows(self):
+        """Rows derive the missing columns like the amortization loop"""
+        table = ds.PayoffTable('dummy', datetime.date(2020, 1, 31))
+        for row in ds.iter_amortization('dummy', '10000', '150', '12'):
+            table.append(row.start_balance, row.new_balance, row.payment)
+        rows = list(ds.iter_amortization('dummy', '10000', '150', '12'))
+        self.assertEqual(len(table), len(rows))
+        for expected, row in zip(rows, table):
+            self.assertEqual(expected[1:], (row.start_balance, row.new_balance, row.payment,
+                                            row.paid_balance, row.interest_payment,
+                                            row.principal_payment))
+        self.assertEqual(table[-1].paid_balance, 0)
+        self.assertEqual(table[1].month, datetime.date(2020, 2, 29))
+
+    def test_index_error(self):
+        """Indexing past the end raises IndexError"""
+        table = ds.PayoffTable('dummy', datetime.date(2020, 1, 1))
+        self.assertRaises(IndexError, table.__getitem__, 0)
+        self.assertRaises(IndexError, table.__getitem__, -1)
+
+    def test_combined_tables(self):
+        """Unformatted combined tables are PayoffTables"""
+        results = ds.calculate_combined_payoff_tables([{'apr': '12', 'balance': '10000',
+                                                        'debt_name': 'debt b', 'payment': '300'},
+                                                       {'apr': '12', 'balance': '10000',
+                                                        'debt_name': 'debt a', 'payment': '200'}],
+                                                      formatted=False)
+        self.assertIsInstance(results[1]['payoff_chart'], ds.PayoffTable)
+        self.assertEqual(ds.money_fmt(results[0]['payoff_chart'][-1].start_balance), '$222.73')
+        self.assertEqual(ds.money_fmt(results[1]['payoff_chart'][-1].start_balance), '$250.55')
+
+class TestMonthCalendar(unittest.TestCase):
+    def test_add_months(self):
+        """Months are added the way relativedelta adds them"""
+        start = datetime.date(2023, 1, 1)
+        for day in range(366 * 4):
+            date = start + datetime.timedelta(days=day)
+            for months in (0, 1, 13, 59, 360):
+                self.assertEqual(ds.add_months(date, months), date + relativedelta(months=months))
+
+    def test_shared(self):
+        """Month dates are worked out once per start date"""
+        today = datetime.date.today()
+        dates = ds.month_dates(today, 12)
+        self.assertIs(ds.month_dates(today, 12), dates)
+        self.assertEqual(ds.month_date(today, 700), today + relativedelta(months=700))
+        self.assertEqual(ds.month_dates(today, 12)[:len(dates)], dates)
+
+class TestCentsArithmetic(unittest.TestCase):
+    def test_to_cents(self):
+        """Money amounts round half-even to whole cents"""
+        self.assertEqual(ds.to_cents('95113.31'), 9511331)
+        self.assertEqual(ds.to_cents('0.125'), 12)
+        self.assertEqual(ds.to_cents('0.135'), 14)
+        self.assertEqual(ds.to_cents(300), 30000)
+        self.assertRaises(ValueError, ds.to_cents, 'Dog')
+        self.assertRaises(ValueError, ds.to_cents, 'inf')
+
+    def test_interest_rounding(self):
+        """Interest rounds half-even to the cent"""
+        # 12% APR is 1% a month
+        self.assertEqual(ds._cents_interest(50, ds._monthly_rate('12')), 0)
+        self.assertEqual(ds._cents_interest(150, ds._monthly_rate('12')), 2)
+        self.assertEqual(ds._cents_interest(151, ds._monthly_rate('12')), 2)
+
+    def test_single_loan(self):
+        """Every month is exact to the cent"""
+        rows = list(ds.iter_amortization('dummy', '95113.31', '1111.67', '5.375', cents=True))
+        self.assertEqual(len(rows), 109)
+        balance = Decimal('95113.31')
+        for row in rows:
+            interest = (balance * Decimal('5.375') / 1200).quantize(Decimal('0.01'))
+            self.assertEqual(ds.to_cents(row.start_balance), ds.to_cents(balance))
+            self.assertEqual(ds.to_cents(row.interest_payment), ds.to_cents(interest))
+            balance = max(balance + interest - Decimal('1111.67'), 0)
+        self.assertEqual(balance, 0)
+        self.assertEqual(sum(ds.to_cents(row.principal_payment) for row in rows), 9511331)
+
+    def test_growing_balance_abort(self):
+        """Cents arithmetic should abort if balance is growing"""
+        self.assertRaises(ds.RisingBalance, ds.do_amortization, 'dummy', '95113.31', '100', '5.375',
+                          cents=True)
+
+    def test_combined_tables(self):
+        """Combined tables keep integer cents"""
+        results = ds.calculate_combined_payoff_tables([{'apr': '12', 'balance': '10000',
+                                                        'debt_name': 'debt b', 'payment': '300'},
+                                                       {'apr': '12', 'balance': '10000',
+                                                        'debt_name': 'debt a', 'payment': '200'}],
+                                                      formatted=False, cents=True)
+        table = results[1]['payoff_chart']
+        self.assertEqual(table.start_balance.typecode, 'q')
+        self.assertEqual(table[0].start_balance, 10000)
+        self.assertEqual(sum(ds.to_cents(row.principal_payment) for row in table), 1000000)
+
+class TestPayoffMonths(unittest.TestCase):
+    def test_matches_amortization(self):
+        """Closed-form payoff time should match the amortization length"""
+        for args in [('95113.31', '1111.67', '5.375'), ('10000', '150', '12'),
+                     ('1000', '100', '0'), ('250000', '1342.05', '4.5'), ('1', '1', '5.3')]:
+            self.assertEqual(len(ds.do_amortization('dummy', *args)),
+                             ds.payoff_months('dummy', *args))
+
+    def test_zero_balance(self):
+        """A paid off debt needs no payments"""
+        self.assertEqual(ds.payoff_months('dummy', '0', '100', '5'), 0)
+
+    def test_growing_balance_abort(self):
+        """Payoff time should abort if balance is growing"""
+        self.assertRaises(ds.RisingBalance, ds.payoff_months, 'dummy', '95113.31', '100', '5.375')
+
 class TestMoneyFormat(unittest.TestCase):
     def test_negative_sign(self):
         """A test case so we get full covergage :)"""
@@ -32,6 +163,114 @@ class TestMoneyFormat(unittest.TestCase):
         """Test an empty number, again, for full coverage"""
         self.assertEqual(ds.money_fmt(0), '$0.00')
 
+    def test_matches_decimal_recipe(self):
+        """The float fast path formats exactly like the Decimal recipe"""
+        values = [0.0, -0.0, 0.005, 0.015, 2.675, -2.675, -0.001, 1234567.125, 95113.31, 1e15, 7]
+        for kwargs in [{}, {'places': 0, 'sep': '.', 'dp': '', 'neg': '', 'trailneg': '-'},
+                       {'neg': '(', 'trailneg': ')'}, {'sep': ' '}, {'pos': '+', 'curr': ''}]:
+            for value in values:
+                self.assertEqual(ds._decimal_money_fmt(value, **kwargs), ds.money_fmt(value, **kwargs))
+
+    def test_decimal(self):
+        """Decimals still go through the recipe"""
+        self.assertEqual(ds.money_fmt(Decimal('-1234567.8901')), '-$1,234,567.89')
+
+    def test_column(self):
+        """Format a whole column at once"""
+        values = [-10, 0, 2.675, 1234567.125]
+        self.assertEqual(ds.money_fmt_column(values), [ds.money_fmt(v) for v in values])
+        self.assertEqual(ds.money_fmt_column(values, sep=' '), [ds.money_fmt(v, sep=' ') for v in values])
+
+class TestResultCache(unittest.TestCase):
+    def test_lru(self):
+        """The least recently used entry is evicted first"""
+        cache = ds.ResultCache(maxsize=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 3)
+        cache.get('c', lambda: 4)
+        self.assertEqual(cache.get('a', lambda: 5), 1)
+        self.assertEqual(cache.get('b', lambda: 6), 6)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 4, 'size': 2, 'maxsize': 2})
+
+    def test_ttl(self):
+        """Entries expire after ttl seconds"""
+        now = [0]
+        cache = ds.ResultCache(ttl=10, clock=lambda: now[0])
+        cache.get('a', lambda: 1)
+        now[0] = 9
+        self.assertEqual(cache.get('a', lambda: 2), 1)
+        now[0] = 10
+        self.assertEqual(cache.get('a', lambda: 3), 3)
+
+    def test_resubmitted_form(self):
+        """Resubmitting a form, even reformatted, reuses the results"""
+        ds.horizon_cache.clear()
+        ds.table_cache.clear()
+        fields = {'row_count': '2', 'debt_name_1': 'debt a', 'balance_1': '$10,000',
+                  'payment_1': '$300', 'apr_1': '12%', 'debt_name_2': 'debt b',
+                  'balance_2': '$10,000', 'payment_2': '$200', 'apr_2': '12%'}
+        ds.process_form(dict(fields))
+        fields['balance_1'] = '10000.00'
+        ds.process_form(dict(fields))
+        self.assertEqual(ds.cache_stats()['horizon']['hits'], 2)
+        self.assertEqual(ds.cache_stats()['tables']['hits'], 1)
+        fields['balance_2'] = '9000'
+        ds.process_form(dict(fields))
+        self.assertEqual(ds.cache_stats()['horizon']['hits'], 3)
+        self.assertEqual(ds.cache_stats()['tables']['misses'], 2)
+
+class TestMetrics(unittest.TestCase):
+    def test_timings(self):
+        """Stages are timed for the process and the current request"""
+        metrics = ds.Metrics()
+        metrics.start_request()
+        with metrics.timed('parse'):
+            pass
+        with metrics.timed('parse'):
+            pass
+        self.assertEqual(list(metrics.request_timings()), ['parse'])
+        self.assertEqual(metrics.stages['parse'][0], 2)
+        self.assertRegex(metrics.server_timing(), r'^parse;dur=[0-9.]+$')
+        metrics.start_request()
+        self.assertEqual(metrics.server_timing(), '')
+
+    def test_prometheus(self):
+        """Counters come out in the Prometheus text format"""
+        metrics = ds.Metrics()
+        metrics.count('errors', type='TooFewDebts')
+        metrics.count('errors', type='TooFewDebts')
+        metrics.count('debts', 3)
+        text = metrics.prometheus()
+        self.assertIn('# TYPE debtsnowball_errors_total counter\n'
+                      'debtsnowball_errors_total{type="TooFewDebts"} 2\n', text)
+        self.assertIn('debtsnowball_debts_total 3\n', text)
+
+class TestTemplateCache(unittest.TestCase):
+    def test_cached(self):
+        """The compiled template is reused between requests"""
+        self.assertIs(ds.load_template(), ds.load_template())
+
+    def test_empty_page(self):
+        """The empty form is only rendered once"""
+        self.assertIs(ds.render_page(), ds.render_page())
+
+    def test_bytecode_cache_dir(self):
+        """Compiled templates go in the app's own cache directory"""
+        template_dir = os.path.dirname(os.path.abspath(ds.rc.template_file))
+        bytecode_cache_dir = getattr(ds.rc, 'bytecode_cache_dir', None)
+        ds.rc.bytecode_cache_dir = None
+        try:
+            self.assertEqual(ds._bytecode_cache(template_dir).directory,
+                             os.path.join(template_dir, '.template_cache'))
+            with tempfile.TemporaryDirectory() as directory:
+                ds.rc.bytecode_cache_dir = os.path.join(directory, 'templates')
+                env = ds._template_environment()
+                env.get_template(os.path.basename(ds.rc.template_file))
+                self.assertEqual(len(os.listdir(ds.rc.bytecode_cache_dir)), 1)
+        finally:
+            ds.rc.bytecode_cache_dir = bytecode_cache_dir
+
 class TestFromProcessing(unittest.TestCase):
     def test_incomplete_values(self):
         """Send a line with incomplete data"""
@@ -83,6 +322,24 @@ class TestFromProcessing(unittest.TestCase):
                                   'balance_2': '1', 'payment_2': '1', 'apr_2': '5.3',
                                   'debt_name_3': '', 'balance_3': '', 'payment_3': '', 'apr_3':''})
 
+    def test_parse_debts(self):
+        """Debts are parsed once into Decimals"""
+        debts = ds.parse_debts({'row_count': '3', 'debt_name_1': 'debt a', 'balance_1': '$10,000',
+                                'payment_1': '$300', 'apr_1':' 12% ',
+                                'debt_name_2': 'debt b', 'balance_2':'500',
+                                'payment_2': '50', 'apr_2': '0'})
+        self.assertEqual(debts, [{'debt_name': 'debt a', 'balance': Decimal('10000'),
+                                  'payment': Decimal('300'), 'apr': Decimal('12')},
+                                 {'debt_name': 'debt b', 'balance': Decimal('500'),
+                                  'payment': Decimal('50'), 'apr': Decimal('0')}])
+
+    def test_row_count_limit(self):
+        """Refuse a row_count over max_rows without looping over it"""
+        self.assertRaises(ds.TooLarge, ds.parse_debts, {'row_count': '1000000000'})
+        self.assertRaises(ValueError, ds.parse_debts, {'row_count': '2', 'debt_name_1': 'a',
+                                                       'balance_1': 'inf', 'payment_1': '1',
+                                                       'apr_1': '1'})
+
 
 class TestDebtSorting(unittest.TestCase):
     def test_sort_debts(self):
@@ -98,6 +355,89 @@ class TestDebtSorting(unittest.TestCase):
         self.assertEqual('debt a', results[1]['debt_name'])
         self.assertEqual('debt c', results[2]['debt_name'])
 
+class TestStrategies(unittest.TestCase):
+    fields = {'row_count': '3',
+              'debt_name_1': 'car', 'balance_1': '8000', 'payment_1': '250', 'apr_1': '4.5',
+              'debt_name_2': 'card', 'balance_2': '3000', 'payment_2': '90', 'apr_2': '24.9',
+              'debt_name_3': 'loan', 'balance_3': '1500', 'payment_3': '100', 'apr_3': '9'}
+
+    def test_order_debts(self):
+        """Each strategy orders the debts its own way"""
+        debts = ds.prepare_debts(self.fields)
+        orders = dict((strategy, [d['debt_name'] for d in ds.order_debts(debts, strategy)])
+                      for strategy in ds.STRATEGIES)
+        self.assertEqual(orders, {'payoff_time': ['loan', 'car', 'card'],
+                                  'snowball': ['loan', 'card', 'car'],
+                                  'avalanche': ['card', 'loan', 'car'],
+                                  'custom': ['car', 'card', 'loan']})
+        self.assertRaises(ds.InvalidStrategy, ds.order_debts, debts, 'lottery')
+
+    def test_compare(self):
+        """Avalanche pays the least interest, and identical orders share results"""
+        ds.table_cache.clear()
+        results = dict((r['strategy'], r) for r in ds.compare_strategies(self.fields))
+        self.assertEqual(list(results), list(ds.STRATEGIES))
+        for result in results.values():
+            self.assertLessEqual(results['avalanche']['total_interest'], result['total_interest'])
+        self.assertLess(results['avalanche']['total_interest'], results['custom']['total_interest'])
+        for result in results.values():
+            self.assertAlmostEqual(result['total_paid'] - result['total_interest'], 12500, places=6)
+        self.assertEqual(ds.table_cache.stats()['misses'], 4)
+
+        # Debts entered in snowball order share one simulation
+        ds.table_cache.clear()
+        fields = dict(self.fields, debt_name_1='loan', balance_1='1500', payment_1='100', apr_1='9',
+                      debt_name_3='car', balance_3='8000', payment_3='250', apr_3='4.5')
+        ds.compare_strategies(fields)
+        self.assertEqual(ds.table_cache.stats()['hits'], 1)
+
+    def test_strategy_field(self):
+        """The strategy field picks the payoff order"""
+        fields = dict(self.fields, strategy='avalanche')
+        self.assertEqual([r['debt_name'] for r in ds.compute_payoff_tables(fields)],
+                         ['card', 'loan', 'car'])
+
+class TestExtraPayment(unittest.TestCase):
+    debts = [{'apr': '9', 'balance': '1500', 'debt_name': 'loan', 'payment': '100'},
+             {'apr': '4.5', 'balance': '8000', 'debt_name': 'car', 'payment': '250'},
+             {'apr': '24.9', 'balance': '3000', 'debt_name': 'card', 'payment': '90'}]
+
+    def months_with(self, extra, **kwargs):
+        snowball = ds.Snowball(self.debts, extra_payment=extra, **kwargs)
+        return snowball.run().month
+
+    def test_solve(self):
+        """The solved payment is the smallest, to the cent, that meets the target"""
+        for kwargs in [{}, {'immediate_rollover': True}, {'cents': True}, {'extra_start': 4}]:
+            extra = ds.solve_extra_payment(self.debts, 20, **kwargs)
+            self.assertLessEqual(self.months_with(extra, **kwargs), 20)
+            self.assertGreater(self.months_with(extra - 0.01, **kwargs), 20)
+
+    def test_no_extra_needed(self):
+        """Debts already paid off in time need nothing extra"""
+        self.assertEqual(ds.solve_extra_payment(self.debts, self.months_with(0)), 0)
+
+    def test_unreachable(self):
+        """Some targets can't be met"""
+        self.assertRaises(ds.InvalidTarget, ds.solve_extra_payment, self.debts, 2)
+        self.assertRaises(ds.InvalidTarget, ds.solve_extra_payment, self.debts, 20, extra_start=20)
+
+    def test_resume(self):
+        """A copied simulation carries on like the original"""
+        snowball = ds.Snowball(self.debts, record=False).run(until=5)
+        other = snowball.copy()
+        snowball.run()
+        self.assertEqual(snowball.balances, [0, 0, 0])
+        self.assertNotEqual(other.balances, [0, 0, 0])
+        self.assertEqual(other.run().month, snowball.month)
+
+    def test_target_months(self):
+        """Count months through the target month"""
+        next_year = datetime.date.today() + relativedelta(years=1)
+        self.assertEqual(ds.target_months('%d-%d' % (next_year.year, next_year.month)), 13)
+        for target in ['2000-01', 'soon', None, '2040-13']:
+            self.assertRaises(ds.InvalidTarget, ds.target_months, target)
+
 class TestDebtCombinedPayoff(unittest.TestCase):
     def test_combined_payoff(self):
         """Payoff debts, with snowball"""
@@ -116,3 +456,252 @@ class TestDebtCombinedPayoff(unittest.TestCase):
         self.assertEqual(ds.money_fmt(222.73), results[0]['payoff_chart'][-1]['start_balance'])
         self.assertEqual(ds.money_fmt(250.55), results[1]['payoff_chart'][-1]['start_balance'])
         self.assertEqual(ds.money_fmt(502.83), results[2]['payoff_chart'][-1]['start_balance'])
+
+    def test_matches_sequential_amortization(self):
+        """The single pass should match amortizing each debt after the last"""
+        sorted_debts = [{'apr': '12', 'balance': '10000', 'debt_name': 'debt b', 'payment': '300'},
+                        {'apr': '7.5', 'balance': '4000', 'debt_name': 'debt a', 'payment': '100'},
+                        {'apr': '19.9', 'balance': '12500', 'debt_name': 'debt c', 'payment': '210'}]
+        additional_start = datetime.date(9999, 12, 31)
+        additional_payment = 0
+        expected = []
+        for debt in sorted_debts:
+            expected.append(ds.do_amortization(debt['debt_name'], debt['balance'], debt['payment'],
+                                               debt['apr'], additional_start, additional_payment))
+            additional_start = expected[-1][-1]['month']
+            additional_payment += float(debt['payment'])
+
+        results = ds.calculate_combined_payoff_tables(sorted_debts)
+        self.assertEqual(expected, [r['payoff_chart'] for r in results])
+
+    def test_immediate_rollover(self):
+        """Leftover payment in a payoff month goes straight to the next debt"""
+        sorted_debts = [{'apr': '12', 'balance': '1000', 'debt_name': 'debt a', 'payment': '300'},
+                        {'apr': '12', 'balance': '10000', 'debt_name': 'debt b', 'payment': '200'}]
+        monthly = ds.simulate_snowball(sorted_debts)
+        immediate = ds.simulate_snowball(sorted_debts, immediate_rollover=True)
+        self.assertEqual(monthly[0]['payoff_chart'], immediate[0]['payoff_chart'])
+        payoff_month = len(monthly[0]['payoff_chart']) - 1
+        self.assertEqual(monthly[1]['payoff_chart'][payoff_month]['payment'], ds.money_fmt(200))
+        self.assertNotEqual(immediate[1]['payoff_chart'][payoff_month]['payment'], ds.money_fmt(200))
+        self.assertLessEqual(len(immediate[1]['payoff_chart']), len(monthly[1]['payoff_chart']))
+
+    def test_paid_off_debt(self):
+        """A debt with no balance frees its payment from the first month"""
+        results = ds.calculate_combined_payoff_tables([{'apr': '12', 'balance': '0',
+                                                        'debt_name': 'debt a', 'payment': '100'},
+                                                       {'apr': '12', 'balance': '1000',
+                                                        'debt_name': 'debt b', 'payment': '100'}])
+        self.assertEqual(results[0]['payoff_chart'], [])
+        self.assertEqual(results[1]['payoff_chart'][0]['payment'], ds.money_fmt(200))
+
+class TestServing(unittest.TestCase):
+    debts = [{'apr': '12', 'balance': '10000', 'debt_name': 'debt b', 'payment': '300'},
+             {'apr': '12', 'balance': '10000', 'debt_name': 'debt a', 'payment': '200'}]
+
+    def test_simulation_pool(self):
+        """Simulating in the process pool gives the same tables"""
+        expected = ds.simulate_snowball(self.debts)
+        ds.table_cache.clear()
+        ds.start_simulation_pool(1)
+        try:
+            self.assertEqual(expected, ds.calculate_combined_payoff_tables(self.debts))
+        finally:
+            ds.stop_simulation_pool()
+            ds.table_cache.clear()
+
+    def test_serve_modes(self):
+        """Forked processes don't mix with threads or the simulation pool"""
+        self.assertRaises(ValueError, ds.serve, threads=4, processes=4)
+        self.assertRaises(ValueError, ds.serve, processes=4, simulation_workers=2)
+        self.assertIsNone(ds.simulation_pool)
+
+    def test_budget(self):
+        """Portfolios over max_debts or max_months are refused"""
+        fields = {'row_count': '2',
+                  'debt_name_1': 'debt a', 'balance_1':'10000', 'payment_1': '200', 'apr_1': '12',
+                  'debt_name_2': 'debt b', 'balance_2':'10000', 'payment_2': '300', 'apr_2': '12'}
+        self.assertEqual(len(ds.ordered_debts(fields)), 2)
+        for name, limit in (('max_debts', 1), ('max_months', 100)):
+            old = getattr(ds.rc, name, None)
+            setattr(ds.rc, name, limit)
+            try:
+                self.assertRaises(ds.TooLarge, ds.ordered_debts, fields)
+            finally:
+                setattr(ds.rc, name, old)
+
+    def test_budget_default(self):
+        """A huge payoff horizon is refused without any limits configured"""
+        fields = {'row_count': '2',
+                  'debt_name_1': 'debt a', 'balance_1':'1e12', 'payment_1': '0.01', 'apr_1': '0',
+                  'debt_name_2': 'debt b', 'balance_2':'10000', 'payment_2': '300', 'apr_2': '12'}
+        saved = {}
+        for name in ('max_debts', 'max_months'):
+            if hasattr(ds.rc, name):
+                saved[name] = getattr(ds.rc, name)
+                delattr(ds.rc, name)
+        try:
+            self.assertRaises(ds.TooLarge, ds.ordered_debts, fields)
+        finally:
+            for name, value in saved.items():
+                setattr(ds.rc, name, value)
+
+class TestSummaryView(unittest.TestCase):
+    fields = {'row_count': '3',
+              'debt_name_1': 'debt a', 'balance_1':'10000', 'payment_1': '200', 'apr_1': '12',
+              'debt_name_2': 'debt b', 'balance_2':'10000', 'payment_2': '300', 'apr_2': '12',
+              'debt_name_3': 'debt c', 'balance_3':'5000', 'payment_3': '100', 'apr_3': '7'}
+
+    def test_year(self):
+        """Yearly summaries add up to the months and break at January"""
+        for debt in ds.summarize_tables(ds.compute_payoff_tables(self.fields), 'year'):
+            chart = debt['payoff_chart']
+            summary = debt['summary']
+            self.assertEqual(summary[-1].end, len(chart))
+            self.assertAlmostEqual(sum(row.payment for row in summary),
+                                   sum(row.payment for row in chart))
+            self.assertAlmostEqual(sum(row.interest_payment for row in summary),
+                                   sum(row.interest_payment for row in chart))
+            for row in summary[1:]:
+                self.assertEqual(row.first_month.month, 1)
+                self.assertEqual(row.first_month, chart[row.start].month)
+
+    def test_phase(self):
+        """Phases end when a debt is paid off"""
+        results = ds.summarize_tables(ds.compute_payoff_tables(self.fields), 'phase')
+        self.assertEqual([len(debt['summary']) for debt in results], [1, 2, 3])
+        self.assertEqual([row.end for row in results[2]['summary']],
+                         [len(debt['payoff_chart']) for debt in results])
+        self.assertEqual(results[2]['summary'][-1].paid_balance, 0)
+        self.assertRaises(ds.InvalidView, ds.summarize_tables, results, 'week')
+
+    def test_paid_off_debt(self):
+        """A debt with no balance has an empty summary"""
+        fields = dict(self.fields, balance_3='0')
+        for view in ('year', 'phase'):
+            results = ds.summarize_tables(ds.compute_payoff_tables(fields), view)
+            self.assertEqual(results[0]['debt_name'], 'debt c')
+            self.assertEqual(results[0]['summary'], [])
+            self.assertTrue(results[1]['summary'])
+
+    def test_months(self):
+        """Months of a schedule are picked out by row"""
+        payoff_tables = ds.compute_payoff_tables(self.fields)
+        rows = ds.schedule_months(payoff_tables, 'debt c', '41', '46')
+        self.assertEqual([row.start_balance for row in rows],
+                         [row.start_balance for row in payoff_tables[1]['payoff_chart']][41:46])
+        for args in (('debt d', 0, 1), ('debt c', 5, 5), ('debt c', 0, 100), ('debt c', 'x', 1)):
+            self.assertRaises(ds.InvalidRange, ds.schedule_months, payoff_tables, *args)
+
+class TestPlanStore(unittest.TestCase):
+    fields = {'row_count': '3',
+              'debt_name_1': 'debt a', 'balance_1':'10000', 'payment_1': '200', 'apr_1': '12',
+              'debt_name_2': 'debt b', 'balance_2':'3000', 'payment_2': '300', 'apr_2': '12',
+              'debt_name_3': 'debt c', 'balance_3':'5000', 'payment_3': '100', 'apr_3': '7'}
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.store_path = getattr(ds.rc, 'store_path', None)
+        ds.rc.store_path = self.path
+        ds._plan_store = None
+
+    def tearDown(self):
+        ds.plan_store().close()
+        ds._plan_store = None
+        ds.rc.store_path = self.store_path
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        """A saved plan loads with the same debts and tables"""
+        payoff_tables, plan_id = ds.save_plan(self.fields)
+        plan = ds.plan_store().load(plan_id)
+        self.assertEqual([debt['debt_name'] for debt in plan['debts']], ['debt b', 'debt c', 'debt a'])
+        self.assertEqual(plan['debts'][0]['balance'], Decimal('3000'))
+        for saved, loaded in zip(payoff_tables, plan['payoff_tables']):
+            saved, loaded = saved['payoff_chart'], loaded['payoff_chart']
+            self.assertEqual(saved.debt_name, loaded.debt_name)
+            self.assertEqual(saved.month(0), loaded.month(0))
+            for column in ('start_balance', 'new_balance', 'payment'):
+                self.assertEqual(getattr(saved, column), getattr(loaded, column))
+        self.assertEqual(ds.plan_fields(plan)['debt_name_1'], 'debt b')
+        self.assertIsNone(ds.plan_store().load('nosuchid'))
+
+    def test_resume(self):
+        """Resuming a plan picks up the saved schedule at this month"""
+        for cents in (False, True):
+            ds.rc.cents = cents
+            try:
+                payoff_tables, plan_id = ds.save_plan(self.fields)
+            finally:
+                ds.rc.cents = False
+            plan = ds.plan_store().load(plan_id)
+            for months in (0, 5, 12, 30, 100):
+                plan['start_date'] = datetime.date.today() - relativedelta(months=months)
+                for saved, resumed in zip(payoff_tables, ds.resume_plan(plan)):
+                    saved, resumed = saved['payoff_chart'], resumed['payoff_chart']
+                    self.assertEqual(saved.payment[months:], resumed.payment)
+                    self.assertEqual(saved.start_balance[months:], resumed.start_balance)
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        fd, self.csv_path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write('id,debt_name,balance,payment,apr\n'
+                    '1,debt a,10000,200,12\n1,debt b,10000,300,12\n1,debt c,10000,150,12\n'
+                    '2,debt a,10000,200,12\n')
+        fd, self.jsonl_path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps({'id': 'x', 'debts': [{'debt_name': 'a', 'balance': 1000,
+                                                      'payment': 100, 'apr': 5},
+                                                     {'debt_name': 'b', 'balance': 1000,
+                                                      'payment': 1, 'apr': 5}]}) + '\n')
+
+    def tearDown(self):
+        os.remove(self.csv_path)
+        os.remove(self.jsonl_path)
+
+    def test_csv(self):
+        """Run a CSV batch in process, keeping input order"""
+        output = io.StringIO()
+        self.assertEqual(ds.run_batch(self.csv_path, output, workers=1, schedules=True), 2)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(['debt b', 'debt a', 'debt c'], [d['debt_name'] for d in results[0]['debts']])
+        self.assertEqual(results[0]['debts'][2]['months'], len(results[0]['debts'][2]['payoff_chart']))
+        self.assertEqual(results[1], {'id': '2', 'error': 'Two or more debts must be provided.'})
+
+    def test_process_pool(self):
+        """A process pool gives the same results"""
+        output = io.StringIO()
+        ds.run_batch(self.csv_path, output, workers=1)
+        pooled = io.StringIO()
+        ds.run_batch(self.csv_path, pooled, workers=2)
+        self.assertEqual(output.getvalue(), pooled.getvalue())
+
+    def test_large_batch(self):
+        """Results keep their order over more chunks than are in flight"""
+        with open(self.csv_path, 'w') as f:
+            f.write('id,debt_name,balance,payment,apr\n')
+            for num in range(300):
+                f.write('%d,debt a,%d,200,12\n%d,debt b,10000,300,12\n' % (num, 1000 + num, num))
+        output = io.StringIO()
+        self.assertEqual(ds.run_batch(self.csv_path, output, workers=2), 300)
+        ids = [json.loads(line)['id'] for line in output.getvalue().splitlines()]
+        self.assertEqual(ids, [str(num) for num in range(300)])
+
+    def test_bad_lines(self):
+        """A line that isn't a portfolio is an error, and the batch goes on"""
+        with open(self.jsonl_path, 'a') as f:
+            f.write('{"id": "y", "debts": [\n[1, 2]\n')
+        output = io.StringIO()
+        self.assertEqual(ds.run_batch(self.jsonl_path, output, workers=1), 3)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(results[1], {'id': None, 'error': ds.error_message(ds.InvalidData())})
+        self.assertEqual(results[2], results[1])
+
+    def test_jsonl(self):
+        """Read JSON lines portfolios"""
+        output = io.StringIO()
+        ds.run_batch(self.jsonl_path, output, workers=1)
+        self.assertEqual(json.loads(output.getvalue()),
+                         {'id': 'x', 'error': "Debt 'b' does not have a large enough payment to reduce the balance."})
@@ -1,12 +1,19 @@
 #!/usr/bin/python3
 
 import os
+import shutil
 import sys
 import unittest
 
 # Set up the test environment
 opd = os.path.dirname
-sys.path.insert(0, opd(os.path.abspath(__file__)))
+here = opd(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+# The tests run against the example settings unless a local config exists
+config = os.path.join(here, 'debt_snowball_config.py')
+if not os.path.exists(config):
+    shutil.copyfile(config + '.example', config)
 
 import debt_snowball
 